@@ -0,0 +1,84 @@
+import pandas as pd
+
+# Call -> purchase attribution, materialized from merged_data by merge_new into
+# attributed_purchases (see schema.py): one row per (Email, order_number) with
+# the first call made before the order and the order's own timestamps.
+# merge_new.build_merged keeps the earliest qualifying call on every merged
+# row, so the earliest row per order here is the order's earliest qualifying
+# call across all of its products. The dashboard's KPIs, customer table and
+# product mix read it with range queries on first_call_at.
+#
+# When an order has several products, the first title (alphabetically) is the
+# one shown, and COGS is the sum over all of the order's products.
+
+ORDER_BATCH_SIZE = 1000
+
+ATTRIBUTION_INSERT = """
+    INSERT INTO attributed_purchases (
+        Email, order_number, first_call_at, created_at, title,
+        customer_first_name, total_price, COGS
+    )
+    WITH qualifying AS (
+        SELECT
+            Email, order_number, StartTimestamp, created_at, title,
+            customer_first_name, total_price,
+            SUM(COGS) OVER (PARTITION BY Email, order_number) AS COGS,
+            ROW_NUMBER() OVER (
+                PARTITION BY Email, order_number ORDER BY StartTimestamp, title
+            ) AS rn
+        FROM merged_data
+        WHERE order_number IS NOT NULL
+          AND Email IS NOT NULL
+          AND title IS NOT NULL
+          AND created_at IS NOT NULL
+          AND StartTimestamp <= created_at {where}
+    )
+    SELECT
+        Email, order_number, StartTimestamp, created_at, LEFT(title, 255),
+        customer_first_name, total_price, COGS
+    FROM qualifying
+    WHERE rn = 1
+"""
+
+
+def _call_days(cursor, placeholders, batch):
+    cursor.execute(
+        f"SELECT DISTINCT DATE(first_call_at) FROM attributed_purchases WHERE order_number IN ({placeholders})",
+        batch
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def refresh_attributed_purchases(conn, order_numbers=None):
+    # order_numbers=None rebuilds the table. Otherwise only those orders are
+    # re-attributed, and the call days they moved out of or into are returned
+    # so the daily rollups can be refreshed for exactly those days.
+    cursor = conn.cursor()
+    try:
+        if order_numbers is None:
+            cursor.execute("DELETE FROM attributed_purchases")
+            cursor.execute(ATTRIBUTION_INSERT.format(where=""))
+            conn.commit()
+            print(f"🎯 Attributed purchases rebuilt: {cursor.rowcount} rows")
+            return None
+
+        orders = sorted({int(o) for o in order_numbers if o is not None and not pd.isna(o)})
+        days = set()
+        for start in range(0, len(orders), ORDER_BATCH_SIZE):
+            batch = orders[start:start + ORDER_BATCH_SIZE]
+            placeholders = ", ".join(["%s"] * len(batch))
+            days |= _call_days(cursor, placeholders, batch)
+            cursor.execute(f"DELETE FROM attributed_purchases WHERE order_number IN ({placeholders})", batch)
+            cursor.execute(
+                ATTRIBUTION_INSERT.format(where=f"AND order_number IN ({placeholders})"),
+                batch
+            )
+            days |= _call_days(cursor, placeholders, batch)
+            conn.commit()
+        print(f"🎯 Attributed purchases refreshed for {len(orders)} order(s)")
+        return days
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
@@ -0,0 +1,331 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+
+from cogs_catalog import CogsCatalog
+from db_bulk import DEFAULT_CHUNK_SIZE, bulk_upsert, frame_to_rows
+from fetch_retell import CALL_COLUMNS, allowed_numbers, parse_calls_frame
+from fetch_shopify import ORDER_COLUMNS, order_to_row
+from line_items import LINE_ITEM_COLUMNS, line_item_rows
+from merge_new import MERGED_COLUMNS, _pick_email, build_merged
+from dashboard_data import prepare_merged
+
+# Reproducible timings for fetch -> merge -> dashboard on synthetic Retell /
+# Shopify payloads. Each stage records wall time, rows/sec and the process's
+# peak RSS so far (ru_maxrss is a high-water mark, so later stages include the
+# memory of earlier ones). Results are appended to a JSON file so runs can be
+# compared across commits. Stages flagged "reference" time code that only
+# exists here, not in the jobs or the dashboard; leave them out of regression
+# comparisons.
+#
+#   python benchmark.py --calls 100000 --orders 20000
+#   python benchmark.py --calls 1000000 --db mysql   # MYSQL_* must point at a scratch database
+
+# Catalog from data/Trimfinity_COGS.xlsx
+PRODUCTS = [
+    ("Ultimate Duo Beard & Body Trimmer", 1020),
+    ("Trimfinity 1.0 Body & Ball Trimmer", 604),
+    ("Trimfinity 7000 Body and Ball Trimmer", 702),
+    ("Trimfinity 7000 Pro Max Body & Ball trimmer", 850),
+    ("Trimfinity 3 in 1 face trimmer", 915),
+    ("Drin-Finity Hair Dryer For Men", 700),
+    ("Trimfinity Groom & Style Duo", 1615),
+    ("Trimfinity Style & Trim Duo", 1402),
+    ("Trimfinity Edge Shave", 1275),
+    ("Trimfinity Smart Blade", 550),
+]
+
+# Base tables as the jobs expect them; only created when missing, for scratch
+# benchmark databases.
+MYSQL_BASE_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS calls (
+        email VARCHAR(255), StartTimestamp DATETIME NOT NULL, EndTimestamp DATETIME,
+        TotalDurationSec DOUBLE, TotalCost DOUBLE, title VARCHAR(255), to_number VARCHAR(32) NOT NULL,
+        PRIMARY KEY (StartTimestamp, to_number)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS shopify_orders (
+        email VARCHAR(255), order_number BIGINT NOT NULL PRIMARY KEY, created_at DATETIME,
+        total_price VARCHAR(32), discount_codes TEXT, customer_first_name VARCHAR(255),
+        title VARCHAR(255), phone VARCHAR(32)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS merged_data (
+        Email VARCHAR(255), StartTimestamp DATETIME, TotalDurationSec DOUBLE, TotalCost DOUBLE,
+        order_number BIGINT NOT NULL, created_at DATETIME, total_price VARCHAR(32), discount_codes TEXT,
+        customer_first_name VARCHAR(255), title VARCHAR(255) NOT NULL, COGS DOUBLE,
+        PRIMARY KEY (order_number, title), INDEX idx_merged_data_start (StartTimestamp)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS product_cogs (
+        product_title VARCHAR(255) NOT NULL PRIMARY KEY, cogs DOUBLE
+    )
+    """,
+]
+
+SQLITE_CALLS_TABLE = """
+    CREATE TABLE calls (
+        email TEXT, StartTimestamp TEXT NOT NULL, EndTimestamp TEXT, TotalDurationSec REAL,
+        TotalCost REAL, title TEXT, to_number TEXT NOT NULL, phone_key TEXT,
+        PRIMARY KEY (StartTimestamp, to_number)
+    )
+"""
+
+
+# --- SYNTHETIC DATA ---
+def make_phones(count, rng):
+    return [str(n) for n in rng.integers(6_000_000_000, 9_999_999_999, size=count)]
+
+
+def generate_calls(count, phones, rng, start=datetime.datetime(2024, 1, 1)):
+    base_ms = int(start.timestamp() * 1000)
+    start_ms = base_ms + rng.integers(0, 365 * 24 * 3600 * 1000, size=count)
+    durations = np.where(rng.random(count) < 0.3, 0, rng.integers(1_000, 600_000, size=count))
+    from_idx = rng.integers(0, len(allowed_numbers), size=count)
+    phone_idx = rng.integers(0, len(phones), size=count)
+    product_idx = rng.integers(0, len(PRODUCTS), size=count)
+    calls = []
+    for i in range(count):
+        phone = phones[phone_idx[i]]
+        calls.append({
+            "call_id": f"call_{i}",
+            "from_number": allowed_numbers[from_idx[i]],
+            "to_number": "+91" + phone,
+            "start_timestamp": int(start_ms[i]),
+            "end_timestamp": int(start_ms[i] + durations[i]) if durations[i] else None,
+            "retell_llm_dynamic_variables": {
+                "email": f"customer{phone_idx[i]}@example.com",
+                "title": PRODUCTS[product_idx[i]][0],
+            },
+        })
+    return calls
+
+
+def generate_orders(count, phones, rng, start=datetime.datetime(2024, 1, 1)):
+    offsets = rng.integers(0, 365 * 24 * 3600, size=count)
+    phone_idx = rng.integers(0, len(phones), size=count)
+    product_idx = rng.integers(0, len(PRODUCTS), size=count)
+    coupon = rng.random(count) < 0.2
+    orders = []
+    for i in range(count):
+        created = (start + datetime.timedelta(seconds=int(offsets[i]))).strftime("%Y-%m-%dT%H:%M:%S+05:30")
+        title = PRODUCTS[product_idx[i]][0]
+        price = f"{rng.integers(999, 4999)}.00"
+        phone = phones[phone_idx[i]]
+        orders.append({
+            "order_number": 1000 + i,
+            "email": f"customer{phone_idx[i]}@example.com",
+            "created_at": created,
+            "updated_at": created,
+            "total_price": price,
+            "discount_codes": [{"code": "OFF5", "amount": "50.00", "type": "fixed_amount"}] if coupon[i] else [],
+            "customer": {"first_name": f"Customer{phone_idx[i]}"},
+            "line_items": [{"title": title, "quantity": 1, "price": price}],
+            "billing_address": {"phone": f"+91 {phone[:5]} {phone[5:]}"},
+        })
+    return orders
+
+
+# --- STAGE TIMING ---
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(results, name, rows, fn, reference=False):
+    start = time.perf_counter()
+    output = fn()
+    wall = time.perf_counter() - start
+    count = rows(output) if callable(rows) else rows
+    results.append({
+        "stage": name,
+        "rows": count,
+        "wall_s": round(wall, 4),
+        "rows_per_s": round(count / wall, 1) if wall > 0 else None,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "reference": reference,
+    })
+    label = f"{name} (synthetic reference)" if reference else name
+    print(f"⏱️ {label}: {count} rows in {wall:.3f}s ({results[-1]['rows_per_s']} rows/s, peak RSS {results[-1]['peak_rss_mb']} MB)")
+    return output
+
+
+# --- STAGES ---
+def parse_stage(calls):
+    # fetch_calls_for_number parses one number's pages at a time
+    by_number = {}
+    for call in calls:
+        by_number.setdefault(call["from_number"], []).append(call)
+    frames = [parse_calls_frame(number_calls, number) for number, number_calls in by_number.items()]
+    return pd.concat(frames, ignore_index=True)
+
+
+def sqlite_insert_stage(df_calls, path):
+    conn = sqlite3.connect(path)
+    conn.execute("DROP TABLE IF EXISTS calls")
+    conn.execute(SQLITE_CALLS_TABLE)
+    rows = frame_to_rows(df_calls.astype({"StartTimestamp": str, "EndTimestamp": str}), CALL_COLUMNS)
+    sql = f"INSERT OR REPLACE INTO calls ({', '.join(CALL_COLUMNS)}) VALUES ({', '.join(['?'] * len(CALL_COLUMNS))})"
+    for start in range(0, len(rows), DEFAULT_CHUNK_SIZE):
+        conn.executemany(sql, rows[start:start + DEFAULT_CHUNK_SIZE])
+        conn.commit()
+    conn.close()
+    return len(rows)
+
+
+def mysql_insert_stage(conn, table, columns, rows, update_columns):
+    return bulk_upsert(conn, table, columns, rows, update_columns=update_columns)["written"]
+
+
+def merge_stage(df_calls, df_orders, catalog):
+    return build_merged(df_calls.copy(), df_orders.copy(), catalog)
+
+
+def attribute_purchases(frame):
+    # pandas stand-in for the attribution the dashboard reads from
+    # attributed_purchases (first qualifying call per customer). The dashboard
+    # never runs this; with --db mysql the dashboard_sql_* stages time the real
+    # queries.
+    purchases = frame[
+        frame["order_number"].notna() &
+        frame["title"].notna() &
+        frame["created_at"].notna() &
+        (frame["StartTimestamp"] <= frame["created_at"])
+    ]
+    purchases = purchases.sort_values(["StartTimestamp", "created_at", "order_number", "title"], kind="stable")
+    purchases = purchases.drop_duplicates(subset="Email", keep="first")
+    return purchases.rename(columns={"Email": "Customer Email", "total_price": "Price"})
+
+
+def dashboard_prepare_stage(df_merged):
+    frame = df_merged.assign(Email=_pick_email(df_merged))[MERGED_COLUMNS].copy()
+    return prepare_merged(frame)
+
+
+def reference_kpis_stage(frame, df_calls):
+    table = attribute_purchases(frame)
+    connected = int((df_calls["TotalDurationSec"] > 1).sum())
+    purchases = table["Customer Email"].nunique()
+    kpis = {
+        "total_calls": len(df_calls),
+        "connected_calls": connected,
+        "total_call_cost": df_calls["TotalCost"].sum(),
+        "total_purchases": purchases,
+        "total_revenue": table["Price"].sum(),
+        "total_cogs": table["COGS"].sum(),
+    }
+    return table, kpis
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fetch -> merge -> dashboard pipeline on synthetic data")
+    parser.add_argument("--calls", type=int, default=10_000)
+    parser.add_argument("--orders", type=int, default=None, help="defaults to calls / 5")
+    parser.add_argument("--phones", type=int, default=None, help="distinct customer phones, defaults to calls / 3")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--sqlite-path", default=":memory:")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    orders_count = args.orders if args.orders is not None else max(1, args.calls // 5)
+    phones_count = args.phones if args.phones is not None else max(1, args.calls // 3)
+    rng = np.random.default_rng(args.seed)
+    stages = []
+
+    phones = make_phones(phones_count, rng)
+    calls = run_stage(stages, "generate_calls", len, lambda: generate_calls(args.calls, phones, rng))
+    orders = run_stage(stages, "generate_orders", len, lambda: generate_orders(orders_count, phones, rng))
+
+    df_calls = run_stage(stages, "parse_calls", len, lambda: parse_stage(calls))
+    order_rows = [order_to_row(o) for o in orders]
+    df_orders = pd.DataFrame(order_rows, columns=ORDER_COLUMNS)
+    # MySQL DATETIMEs come back without the +05:30 offset, naive like the call times
+    for column in ("created_at", "updated_at"):
+        df_orders[column] = pd.to_datetime(df_orders[column], utc=True).dt.tz_convert(None)
+    catalog = CogsCatalog(dict(PRODUCTS))
+
+    if args.db == "sqlite":
+        run_stage(stages, "insert_calls", lambda n: n, lambda: sqlite_insert_stage(df_calls, args.sqlite_path))
+    else:
+        from db_connection import get_connection
+        import merge_new
+        from dashboard_queries import dashboard_kpis, product_mix, purchase_table, revenue_profit_trend
+        from schema import ensure_schema
+
+        conn = get_connection()
+        cursor = conn.cursor()
+        for ddl in MYSQL_BASE_TABLES:
+            cursor.execute(ddl)
+        conn.commit()
+        cursor.close()
+        ensure_schema(conn)
+        bulk_upsert(conn, "product_cogs", ["product_title", "cogs"], PRODUCTS, update_columns=["cogs"])
+        run_stage(stages, "insert_calls", lambda n: n, lambda: mysql_insert_stage(
+            conn, "calls", CALL_COLUMNS, frame_to_rows(df_calls, CALL_COLUMNS),
+            ["EndTimestamp", "TotalDurationSec", "TotalCost", "title", "to_number", "phone_key"]
+        ))
+        run_stage(stages, "insert_orders", lambda n: n, lambda: mysql_insert_stage(
+            conn, "shopify_orders", ORDER_COLUMNS, order_rows,
+            [c for c in ORDER_COLUMNS if c != "order_number"]
+        ))
+        item_rows = [row for o in orders for row in line_item_rows(o["order_number"], o["line_items"])]
+        run_stage(stages, "insert_line_items", lambda n: n, lambda: mysql_insert_stage(
+            conn, "shopify_order_line_items", LINE_ITEM_COLUMNS, item_rows, ["quantity", "price"]
+        ))
+        conn.close()
+        run_stage(stages, "merge_data_full", len(df_calls) + len(df_orders), lambda: merge_new.merge_data(full=True))
+        first, last = datetime.date(2024, 1, 1), datetime.date(2025, 1, 1)
+        kpis = run_stage(stages, "dashboard_sql_kpis", 1, lambda: dashboard_kpis(first, last))
+        run_stage(stages, "dashboard_sql_purchase_table", len, lambda: purchase_table(first, last))
+        run_stage(stages, "dashboard_sql_product_mix", len, lambda: product_mix(first, last))
+        run_stage(stages, "dashboard_sql_trend", len, lambda: revenue_profit_trend(
+            first, last, "Month", kpis["total_call_cost"], kpis["total_purchases"]
+        ))
+
+    df_merged = run_stage(stages, "merge_join_dedup", len, lambda: merge_stage(df_calls, df_orders, catalog))
+    frame = run_stage(stages, "dashboard_prepare_merged", len, lambda: dashboard_prepare_stage(df_merged))
+    run_stage(
+        stages, "reference_pandas_kpis", lambda out: len(out[0]), lambda: reference_kpis_stage(frame, df_calls),
+        reference=True
+    )
+
+    result = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "db": args.db,
+        "scale": {"calls": args.calls, "orders": orders_count, "phones": phones_count, "seed": args.seed},
+        "stages": stages,
+    }
+    history = []
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            history = json.load(f)
+    history.append(result)
+    with open(args.output, "w") as f:
+        json.dump(history, f, indent=2)
+    print(f"✅ Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import difflib
+import os
+import pickle
+import re
+from functools import lru_cache
+import pandas as pd
+from dotenv import load_dotenv
+from db_connection import fetch_one, read_sql
+
+load_dotenv()
+
+# Product title -> COGS lookup for merge_new. Read from the product_cogs table,
+# or from the checked-in spreadsheet when the DB can't be reached, and cached
+# on disk so repeated runs skip both the table read and the Excel parse. The
+# cache is reused while the table's CHECKSUM (or the file's mtime) matches.
+#
+# Titles are matched on a normalized form (case, punctuation, "&" vs "and");
+# anything still unmatched gets the closest catalog title above
+# COGS_FUZZY_CUTOFF, memoized per catalog in an LRU of COGS_FUZZY_CACHE_SIZE.
+# A fuzzy match must carry exactly the same numeric tokens (model numbers,
+# versions, pack sizes), so "8000" never takes the 7000's cost or "x2" a
+# single unit's; every fuzzy match is logged.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CATALOG_XLSX = os.getenv("COGS_XLSX_PATH", os.path.join(BASE_DIR, "data", "Trimfinity_COGS.xlsx"))
+CACHE_PATH = os.getenv("COGS_CACHE_PATH", os.path.join(BASE_DIR, ".cache", "cogs_catalog.pkl"))
+FUZZY_CUTOFF = float(os.getenv("COGS_FUZZY_CUTOFF", "0.85"))
+FUZZY_CACHE_SIZE = int(os.getenv("COGS_FUZZY_CACHE_SIZE", "4096"))
+
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_title(title):
+    if title is None or pd.isna(title):
+        return ""
+    text = str(title).lower().replace("&", " and ")
+    return _NON_WORD.sub(" ", text).strip()
+
+
+def model_tokens(key):
+    # The tokens of a normalized title that contain a digit: "trimfinity 2 0
+    # x2" -> ("0", "2", "x2")
+    return tuple(sorted(token for token in key.split() if any(c.isdigit() for c in token)))
+
+
+class CogsCatalog:
+    def __init__(self, entries, source=None):
+        # entries: {product title: cogs}
+        self.source = source
+        self.index = {}
+        for title, cogs in entries.items():
+            key = normalize_title(title)
+            if key and key not in self.index:
+                self.index[key] = float(cogs) if cogs is not None and not pd.isna(cogs) else 0.0
+        self._keys_by_model = {}
+        for key in self.index:
+            self._keys_by_model.setdefault(model_tokens(key), []).append(key)
+        self._closest = lru_cache(maxsize=FUZZY_CACHE_SIZE)(self._fuzzy_key)
+
+    # The LRU wrapper can't be pickled; drop it so the catalog can be sent to
+    # merge worker processes (see merge_new._merge_parallel), and rebuild it
+    # on the other side.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_closest"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._closest = lru_cache(maxsize=FUZZY_CACHE_SIZE)(self._fuzzy_key)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _fuzzy_key(self, key):
+        candidates = self._keys_by_model.get(model_tokens(key), [])
+        match = difflib.get_close_matches(key, candidates, n=1, cutoff=FUZZY_CUTOFF)
+        return match[0] if match else None
+
+    def match(self, title):
+        # (catalog key, fuzzy?) for a title, or (None, False) when nothing matches
+        key = normalize_title(title)
+        if not key:
+            return None, False
+        if key in self.index:
+            return key, False
+        match = self._closest(key)
+        return match, match is not None
+
+    def lookup(self, title):
+        key, _ = self.match(title)
+        return self.index[key] if key else None
+
+    def cogs_for(self, titles):
+        # One lookup per distinct title, mapped back over the column; titles
+        # with no match cost 0, as before.
+        mapping = {}
+        for title in titles.dropna().unique():
+            key, fuzzy = self.match(title)
+            mapping[title] = self.index[key] if key else None
+            if fuzzy:
+                print(f"🔎 COGS fuzzy match: '{title}' -> '{key}' ({self.index[key]})")
+        unmatched = sorted(str(t) for t, cogs in mapping.items() if cogs is None)
+        if unmatched:
+            print(f"⚠️ No COGS for {len(unmatched)} title(s): {', '.join(unmatched[:5])}")
+        return pd.to_numeric(titles.map(mapping), errors="coerce").fillna(0).astype("float64")
+
+
+def _read_cache(source):
+    try:
+        with open(CACHE_PATH, "rb") as f:
+            cached = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    return cached["entries"] if cached.get("source") == source else None
+
+
+def _write_cache(source, entries):
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        tmp_path = f"{CACHE_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"source": source, "entries": entries}, f)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError as e:
+        print(f"⚠️ Could not write COGS cache: {e}")
+
+
+def _table_checksum():
+    row = fetch_one("CHECKSUM TABLE product_cogs")
+    if row is None or row[1] is None:
+        raise RuntimeError("product_cogs table not found")
+    return row[1]
+
+
+def _read_table():
+    df = read_sql("SELECT product_title, cogs FROM product_cogs")
+    return dict(zip(df["product_title"], pd.to_numeric(df["cogs"], errors="coerce")))
+
+
+def _read_xlsx():
+    df = pd.read_excel(CATALOG_XLSX, usecols=["NAME", "COGS"])
+    df = df.dropna(subset=["NAME"])
+    return dict(zip(df["NAME"], pd.to_numeric(df["COGS"], errors="coerce")))
+
+
+def load_catalog():
+    try:
+        source = ("product_cogs", _table_checksum())
+        read = _read_table
+    except Exception as e:
+        print(f"⚠️ product_cogs unavailable ({e}), using {os.path.basename(CATALOG_XLSX)}")
+        try:
+            source = ("xlsx", os.path.getmtime(CATALOG_XLSX))
+        except OSError as e:
+            print(f"⚠️ No COGS catalog available: {e}")
+            return None
+        read = _read_xlsx
+
+    entries = _read_cache(source)
+    if entries is None:
+        entries = read()
+        _write_cache(source, entries)
+        print(f"📦 COGS catalog loaded from {source[0]}: {len(entries)} products")
+    else:
+        print(f"📦 COGS catalog reused from cache: {len(entries)} products")
+    return CogsCatalog(entries, source=source)
@@ -0,0 +1,108 @@
+import datetime
+import streamlit as st
+from dotenv import load_dotenv
+from dashboard_queries import (
+    coupon_usage, dashboard_kpis, discount_codes_in_use, product_mix, purchase_table, revenue_profit_trend
+)
+from db_connection import fetch_one, read_sql
+from frame_types import DASHBOARD_MERGED, apply_schema, frame_memory
+from sync_state import DATA_VERSION_KEY
+
+load_dotenv()
+
+# Data changes at most once per sync (every 2 hours); the version probe is cheap
+# and re-checked every minute so a finished sync shows up without waiting out the TTL.
+CACHE_TTL = 2 * 60 * 60
+VERSION_TTL = 60
+
+# Everything else is aggregated in MySQL (see dashboard_queries.py); the row
+# frame only feeds the call-duration histogram.
+HISTOGRAM_COLUMNS = ["StartTimestamp", "TotalDurationSec"]
+
+
+@st.cache_data(ttl=VERSION_TTL, show_spinner=False)
+def get_data_version():
+    # The version the merge job stamps into sync_state when it finishes, plus
+    # MAX(StartTimestamp) on both tables (index lookups, see schema.INDEXES)
+    # for writes made outside the merge.
+    row = fetch_one("""
+        SELECT
+            (SELECT MAX(StartTimestamp) FROM merged_data),
+            (SELECT MAX(StartTimestamp) FROM calls)
+    """)
+    try:
+        stamp = fetch_one("SELECT sync_value FROM sync_state WHERE sync_key = %s", (DATA_VERSION_KEY,))
+    except Exception:
+        stamp = None
+    return str(row) + "|" + str(stamp[0] if stamp else None)
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_date_bounds(version):
+    row = fetch_one("SELECT MIN(DATE(StartTimestamp)), MAX(DATE(StartTimestamp)) FROM merged_data")
+    if not row or row[0] is None:
+        return None, None
+    return row[0], row[1]
+
+
+# --- PREPROCESSING ---
+def prepare_merged(df):
+    # Compact dtypes (see frame_types.py); the footprint before and after is
+    # kept in df.attrs for the sidebar.
+    memory_before = frame_memory(df)
+    apply_schema(df, DASHBOARD_MERGED)
+    df['call_date'] = df['StartTimestamp'].dt.date
+    for column in ['TotalDurationSec', 'TotalCost', 'total_price', 'COGS']:
+        if column in df.columns:
+            df[column] = df[column].fillna(0)
+    df.attrs['memory_before'] = memory_before
+    df.attrs['memory_after'] = frame_memory(df)
+    return df
+
+
+# --- LOAD DATA ---
+@st.cache_data(ttl=CACHE_TTL, show_spinner="Loading data...")
+def load_data(start_date, end_date, version):
+    # Only the selected call-date window and the columns the histogram uses are
+    # read; the half-open upper bound keeps the StartTimestamp index usable.
+    params = (start_date, end_date + datetime.timedelta(days=1))
+    df = read_sql(
+        f"SELECT {', '.join(HISTOGRAM_COLUMNS)} FROM merged_data"
+        " WHERE StartTimestamp >= %s AND StartTimestamp < %s",
+        params=params
+    )
+    return prepare_merged(df)
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_kpis(start_date, end_date, version):
+    return dashboard_kpis(start_date, end_date)
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_trend(start_date, end_date, granularity, total_call_cost, total_purchases, version):
+    return revenue_profit_trend(start_date, end_date, granularity, total_call_cost, total_purchases)
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_purchase_table(start_date, end_date, version):
+    return purchase_table(start_date, end_date)
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_product_mix(start_date, end_date, version):
+    return product_mix(start_date, end_date)
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_discount_codes(version):
+    # order_discount_codes only exists once a sync has run with this version
+    try:
+        return discount_codes_in_use()
+    except Exception:
+        return []
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_coupon_usage(start_date, end_date, codes, version):
+    return coupon_usage(start_date, end_date, list(codes))
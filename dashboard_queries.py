@@ -0,0 +1,172 @@
+import datetime
+import pandas as pd
+from db_connection import fetch_one, read_sql
+
+# KPI and trend aggregates computed inside MySQL so only a handful of rows come
+# back, however large calls / merged_data get. Windows are on the call date
+# (StartTimestamp), matching the dashboard's date filter. Call totals read the
+# daily rollup kept by merge_new (see rollups.py); purchases, including every
+# trend granularity, read attributed_purchases (see attribution.py) through
+# PURCHASES_CTE so the trend and the KPIs count the same customers.
+
+GST_DIVISOR = 118  # prices include 18% GST
+FEE_PER_PURCHASE = 120
+
+PERIOD_SQL = {
+    "Day": "DATE({column})",
+    "Week": "DATE({column}) - INTERVAL WEEKDAY({column}) DAY",
+    "Month": "DATE({column}) - INTERVAL (DAYOFMONTH({column}) - 1) DAY",
+    "Quarter": "MAKEDATE(YEAR({column}), 1) + INTERVAL (QUARTER({column}) - 1) QUARTER",
+}
+
+# One attributed purchase per customer: the earliest order whose first
+# qualifying call (call made before the order) falls inside the window.
+PURCHASES_CTE = """
+    WITH qualifying AS (
+        SELECT
+            Email, order_number, first_call_at AS StartTimestamp, created_at, title,
+            customer_first_name, total_price, COGS,
+            ROW_NUMBER() OVER (
+                PARTITION BY Email ORDER BY first_call_at, created_at, order_number
+            ) AS rn
+        FROM attributed_purchases
+        WHERE first_call_at >= %s AND first_call_at < %s
+    ),
+    purchases AS (
+        SELECT * FROM qualifying WHERE rn = 1
+    )
+"""
+
+
+def _window(start_date, end_date):
+    return (start_date, end_date + datetime.timedelta(days=1))
+
+
+def profit(revenue, cogs, call_cost, purchases):
+    return (revenue / GST_DIVISOR) * 100 - cogs - call_cost - (FEE_PER_PURCHASE * purchases)
+
+
+def call_kpis(start_date, end_date):
+    row = fetch_one("""
+        SELECT
+            COALESCE(SUM(total_calls), 0),
+            COALESCE(SUM(connected_calls), 0),
+            COALESCE(SUM(total_call_cost), 0),
+            COALESCE(SUM(total_duration_sec), 0)
+        FROM daily_call_rollup
+        WHERE call_date >= %s AND call_date <= %s
+    """, (start_date, end_date))
+    return {
+        "total_calls": int(row[0]),
+        "connected_calls": int(row[1]),
+        "total_call_cost": float(row[2]),
+        "total_call_duration": float(row[3]),
+    }
+
+
+def purchase_kpis(start_date, end_date):
+    row = fetch_one(PURCHASES_CTE + """
+        SELECT
+            COUNT(DISTINCT Email),
+            COALESCE(SUM(total_price), 0),
+            COALESCE(SUM(COGS), 0)
+        FROM purchases
+    """, _window(start_date, end_date))
+    return {
+        "total_purchases": int(row[0]),
+        "total_revenue": float(row[1]),
+        "total_cogs": float(row[2]),
+    }
+
+
+def dashboard_kpis(start_date, end_date):
+    kpis = call_kpis(start_date, end_date)
+    kpis.update(purchase_kpis(start_date, end_date))
+    connected = kpis["connected_calls"]
+    kpis["conversion"] = round((kpis["total_purchases"] / connected) * 100, 2) if connected > 0 else 0
+    kpis["profit"] = profit(
+        kpis["total_revenue"], kpis["total_cogs"], kpis["total_call_cost"], kpis["total_purchases"]
+    )
+    return kpis
+
+
+def purchase_table(start_date, end_date):
+    # CAST(... AS CHAR) renders 'YYYY-MM-DD HH:MM:SS' without a DATE_FORMAT
+    # pattern, whose % signs would clash with the driver's placeholders.
+    return read_sql(PURCHASES_CTE + """
+        SELECT
+            DATE(StartTimestamp) AS `Date`,
+            Email AS `Customer Email`,
+            order_number AS `Order Number`,
+            CAST(StartTimestamp AS CHAR) AS `Call Time`,
+            CAST(created_at AS CHAR) AS `Order Time`,
+            title AS `Product Purchased`,
+            COALESCE(total_price, 0) AS `Price`,
+            COALESCE(COGS, 0) AS `COGS`
+        FROM purchases
+        ORDER BY StartTimestamp, created_at, order_number
+    """, params=_window(start_date, end_date))
+
+
+def product_mix(start_date, end_date):
+    return read_sql(PURCHASES_CTE + """
+        SELECT title AS Product, COUNT(*) AS `Count`
+        FROM purchases
+        GROUP BY title
+        ORDER BY `Count` DESC, Product
+    """, params=_window(start_date, end_date))
+
+
+def discount_codes_in_use():
+    # Every code ever used, most used first; an index-only scan of
+    # idx_order_discount_codes_code.
+    codes = read_sql("""
+        SELECT code, COUNT(*) AS orders
+        FROM order_discount_codes
+        GROUP BY code
+        ORDER BY orders DESC, code
+    """)
+    return codes["code"].tolist()
+
+
+def coupon_usage(start_date, end_date, codes):
+    # Merged call/order rows in the call window whose order used any of the codes
+    if not codes:
+        return pd.DataFrame(columns=["Customer Name", "Customer Email", "Order Number", "Coupon Code"])
+    placeholders = ", ".join(["%s"] * len(codes))
+    return read_sql(f"""
+        SELECT DISTINCT
+            m.customer_first_name AS `Customer Name`,
+            m.Email AS `Customer Email`,
+            m.order_number AS `Order Number`,
+            d.code AS `Coupon Code`
+        FROM order_discount_codes d
+        JOIN merged_data m ON m.order_number = d.order_number
+        WHERE d.code IN ({placeholders})
+          AND m.StartTimestamp >= %s AND m.StartTimestamp < %s
+        ORDER BY `Order Number`, `Coupon Code`
+    """, params=list(codes) + list(_window(start_date, end_date)))
+
+
+def revenue_profit_trend(start_date, end_date, granularity, total_call_cost, total_purchases):
+    # Same one-purchase-per-customer set as purchase_kpis(), bucketed by order
+    # date, so the periods add up to the KPI totals. Call cost is allocated to
+    # each period by its share of purchases.
+    period = PERIOD_SQL.get(granularity, PERIOD_SQL["Day"]).format(column="created_at")
+    trend = read_sql(PURCHASES_CTE + f"""
+        SELECT
+            {period} AS Period,
+            COALESCE(SUM(total_price), 0) AS Revenue,
+            COALESCE(SUM(COGS), 0) AS COGS,
+            COUNT(DISTINCT Email) AS Purchases
+        FROM purchases
+        GROUP BY Period
+        ORDER BY Period
+    """, params=_window(start_date, end_date))
+    if trend.empty:
+        return trend
+    for column in ("Revenue", "COGS", "Purchases"):
+        trend[column] = pd.to_numeric(trend[column], errors="coerce").fillna(0)
+    call_cost_share = (total_call_cost * trend["Purchases"] / total_purchases) if total_purchases else 0
+    trend["Profit ₹"] = profit(trend["Revenue"], trend["COGS"], call_cost_share, trend["Purchases"])
+    return trend
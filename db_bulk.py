@@ -0,0 +1,94 @@
+import os
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_CHUNK_SIZE = int(os.getenv("DB_BULK_CHUNK_SIZE", "500"))
+
+
+def build_upsert_sql(table, columns, update_columns=None, guard=None):
+    # guard: SQL condition under which an existing row takes the new values.
+    # MySQL applies the assignments left to right, so a column the guard reads
+    # must come last in update_columns.
+    if update_columns is None:
+        update_columns = columns
+    placeholders = ", ".join(["%s"] * len(columns))
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+    if update_columns:
+        if guard:
+            updates = ", ".join(f"{c} = IF({guard}, VALUES({c}), {c})" for c in update_columns)
+        else:
+            updates = ", ".join(f"{c} = VALUES({c})" for c in update_columns)
+        sql += f" ON DUPLICATE KEY UPDATE {updates}"
+    return sql
+
+
+def frame_to_rows(df, columns):
+    # Pull whole columns as object arrays (Python scalars, NaN/NaT -> None)
+    # instead of building a Series per row with iterrows().
+    arrays = []
+    for column in columns:
+        values = df[column].to_numpy(dtype=object, copy=True)
+        values[pd.isna(df[column]).to_numpy()] = None
+        arrays.append(values)
+    return list(zip(*arrays))
+
+
+def bulk_upsert(conn, table, columns, rows, update_columns=None, chunk_size=None, label=None, guard=None):
+    # mysql-connector rewrites executemany() on a plain INSERT into a single
+    # multi-VALUES statement, so each chunk is one round trip. Every chunk is
+    # committed on its own; a failing chunk is retried row by row so only the
+    # offending rows are dropped.
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    label = label or table
+    sql = build_upsert_sql(table, columns, update_columns, guard)
+    stats = {"rows": len(rows), "written": 0, "failed": 0, "chunks": 0, "round_trips": 0}
+
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            stats["chunks"] += 1
+            try:
+                cursor.executemany(sql, chunk)
+                conn.commit()
+                stats["round_trips"] += 1
+                stats["written"] += len(chunk)
+            except Exception as e:
+                conn.rollback()
+                print(f"⚠️ {label}: chunk {start}-{start + len(chunk) - 1} failed ({e}), retrying row by row")
+                for row in chunk:
+                    try:
+                        cursor.execute(sql, row)
+                        stats["written"] += 1
+                    except Exception as row_error:
+                        stats["failed"] += 1
+                        print(f"❌ {label}: skipping row due to error: {row_error}")
+                    stats["round_trips"] += 1
+                conn.commit()
+    finally:
+        cursor.close()
+
+    print(f"📦 {label}: {stats['written']}/{stats['rows']} rows in {stats['chunks']} chunks ({stats['failed']} failed)")
+    return stats
+
+
+def replace_order_rows(conn, table, columns, order_numbers, rows, update_columns, batch_size):
+    # For tables holding several rows per Shopify order (line items, discount
+    # codes): every listed order's rows are deleted, then rows are upserted,
+    # so entries removed by an order edit disappear too. Returns rows written.
+    if not order_numbers:
+        return 0
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(order_numbers), batch_size):
+            batch = order_numbers[start:start + batch_size]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(f"DELETE FROM {table} WHERE order_number IN ({placeholders})", batch)
+        conn.commit()
+    finally:
+        cursor.close()
+    if not rows:
+        return 0
+    return bulk_upsert(conn, table, columns, rows, update_columns=update_columns)["written"]
@@ -1,22 +1,103 @@
-import mysql.connector
 import os
+import threading
+import time
+import pandas as pd
 from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import URL
 
 load_dotenv()
 
-def get_connection():
-    return mysql.connector.connect(
-        host=os.getenv("MYSQL_HOST"),
-        user=os.getenv("MYSQL_USER"),
-        password=os.getenv("MYSQL_PASSWORD"),
-        database=os.getenv("MYSQL_DATABASE")
-    )
+# One pooled engine per process, shared by the fetch / merge jobs and the
+# dashboard. Sizes can be tuned per deployment through the environment.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
 
-from sqlalchemy import create_engine
-import os
-from dotenv import load_dotenv
+_engine = None
+_engine_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"checkouts": 0, "connects": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def _record_wait(seconds):
+    with _stats_lock:
+        _stats["wait_total"] += seconds
+        _stats["wait_max"] = max(_stats["wait_max"], seconds)
 
-load_dotenv()
 
 def get_engine():
-    return create_engine(f"mysql+mysqlconnector://{os.getenv('MYSQL_USER')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}/{os.getenv('MYSQL_DATABASE')}")
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(
+                URL.create(
+                    "mysql+mysqlconnector",
+                    username=os.getenv("MYSQL_USER"),
+                    password=os.getenv("MYSQL_PASSWORD"),
+                    host=os.getenv("MYSQL_HOST"),
+                    database=os.getenv("MYSQL_DATABASE"),
+                ),
+                pool_size=POOL_SIZE,
+                max_overflow=POOL_MAX_OVERFLOW,
+                pool_timeout=POOL_TIMEOUT,
+                pool_recycle=POOL_RECYCLE,
+                pool_pre_ping=True,
+            )
+            # "connect" fires only when the pool has to open a new physical
+            # connection (a miss); "checkout" fires on every borrow.
+            event.listen(_engine, "connect", lambda *args: _count("connects"))
+            event.listen(_engine, "checkout", lambda *args: _count("checkouts"))
+    return _engine
+
+
+def get_connection():
+    # Raw DBAPI connection borrowed from the pool, for cursor / executemany
+    # writes. close() hands it back to the pool.
+    start = time.perf_counter()
+    conn = get_engine().raw_connection()
+    _record_wait(time.perf_counter() - start)
+    return conn
+
+
+def read_sql(query, params=None, **kwargs):
+    # Reads go through a SQLAlchemy connection so pandas doesn't warn about raw
+    # DBAPI connections; queries keep the driver's %s placeholders.
+    start = time.perf_counter()
+    with get_engine().connect() as conn:
+        _record_wait(time.perf_counter() - start)
+        return pd.read_sql(query, conn, params=tuple(params) if params is not None else None, **kwargs)
+
+
+def fetch_one(query, params=None):
+    start = time.perf_counter()
+    with get_engine().connect() as conn:
+        _record_wait(time.perf_counter() - start)
+        return conn.exec_driver_sql(query, tuple(params) if params is not None else ()).fetchone()
+
+
+def pool_stats():
+    pool = get_engine().pool
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["hits"] = stats["checkouts"] - stats["connects"]
+    stats["wait_avg"] = stats["wait_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    stats["size"] = pool.size()
+    stats["checked_out"] = pool.checkedout()
+    stats["overflow"] = max(0, pool.overflow())
+    return stats
+
+
+def format_pool_stats():
+    s = pool_stats()
+    return (
+        f"🔌 DB pool: {s['checkouts']} checkouts, {s['hits']} hits / {s['connects']} misses, "
+        f"wait avg {s['wait_avg'] * 1000:.1f}ms max {s['wait_max'] * 1000:.1f}ms, "
+        f"{s['checked_out']} checked out of {s['size']} (+{s['overflow']} overflow)"
+    )
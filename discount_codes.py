@@ -0,0 +1,93 @@
+import ast
+import json
+from db_bulk import replace_order_rows
+from db_connection import read_sql
+from sync_state import get_watermark, set_watermark
+
+# Shopify's discount_codes list, parsed once into order_discount_codes (see
+# schema.py): one row per order per code, indexed by code, so the dashboard's
+# coupon tracker is a plain SQL filter. fetch_shopify writes the rows at
+# ingest; merge_new catches up orders stored before the table existed.
+
+DISCOUNT_CODE_COLUMNS = ["order_number", "code", "amount", "discount_type"]
+WATERMARK_KEY = "order_discount_codes.ingested_at"
+ORDER_BATCH_SIZE = 5000
+
+
+def parse_discount_codes(value):
+    # API orders carry a list; stored rows hold the json.dumps() text
+    # fetch_shopify wrote. Older rows may be a Python repr, which literal_eval
+    # reads without executing anything.
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                return []
+    if not isinstance(value, list):
+        return []
+    codes = {}
+    for entry in value:
+        if isinstance(entry, dict):
+            code, amount, discount_type = entry.get("code"), entry.get("amount"), entry.get("type")
+        else:
+            code, amount, discount_type = entry, None, None
+        code = str(code or "").strip().upper()
+        if code and code not in codes:
+            codes[code] = (amount, discount_type)
+    return [(code, amount, discount_type) for code, (amount, discount_type) in codes.items()]
+
+
+def replace_discount_codes(conn, orders):
+    # orders: (order_number, discount_codes) pairs. Each order's rows are
+    # replaced, so codes removed in Shopify disappear here too.
+    order_numbers = []
+    rows = []
+    for order_number, discount_codes in orders:
+        if order_number is None:
+            continue
+        order_numbers.append(order_number)
+        for code, amount, discount_type in parse_discount_codes(discount_codes):
+            rows.append((order_number, code, amount, discount_type))
+    return replace_order_rows(
+        conn, "order_discount_codes", DISCOUNT_CODE_COLUMNS, order_numbers, rows,
+        update_columns=["amount", "discount_type"], batch_size=ORDER_BATCH_SIZE
+    )
+
+
+def sync_discount_codes(conn, until=None, full=False):
+    # Re-parses orders written since this table's own watermark on
+    # shopify_orders.ingested_at (all orders on the first run or with
+    # full=True), paging on order_number.
+    since = None if full else get_watermark(conn, WATERMARK_KEY)
+    where = ["order_number > %s"]
+    params = []
+    if since is not None:
+        where.append("ingested_at >= %s")
+        params.append(since)
+    if until is not None:
+        where.append("ingested_at <= %s")
+        params.append(until)
+    query = (
+        "SELECT order_number, discount_codes FROM shopify_orders"
+        f" WHERE {' AND '.join(where)} ORDER BY order_number LIMIT %s"
+    )
+
+    last = -1
+    orders = 0
+    written = 0
+    while True:
+        batch = read_sql(query, params=[last] + params + [ORDER_BATCH_SIZE])
+        if batch.empty:
+            break
+        written += replace_discount_codes(conn, batch.itertuples(index=False, name=None))
+        orders += len(batch)
+        last = int(batch["order_number"].iloc[-1])
+        if len(batch) < ORDER_BATCH_SIZE:
+            break
+    if until is not None:
+        set_watermark(conn, WATERMARK_KEY, until)
+    print(f"🏷️ Parsed discount codes for {orders} orders, {written} code rows written")
+    return {"orders": orders, "written": written}
@@ -1,137 +1,284 @@
 import requests
 import json
 import os
+import sys
+import threading
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from db_connection import get_connection
+from db_bulk import bulk_upsert, frame_to_rows
+from phones import normalize_phone_series
+from run_stats import RunStats
+from schema import ensure_schema
+from sync_state import get_watermark, set_watermark
 import time
 
 load_dotenv()
 
-allowed_numbers = ["+15109411358", "+12283350337", "+12082140131", "+14707630575"]
+CALL_COLUMNS = ["email", "StartTimestamp", "EndTimestamp", "TotalDurationSec", "TotalCost", "title", "to_number", "phone_key"]
 
-def fetch_calls_for_number(number, retell_api_key):
-    url = "https://api.retellai.com/v2/list-calls"
+DEFAULT_NUMBERS = ["+15109411358", "+12283350337", "+12082140131", "+14707630575"]
+RETELL_API_BASE = os.getenv("RETELL_API_BASE", "https://api.retellai.com")
+PAGE_LIMIT = 1000
+MAX_WORKERS = int(os.getenv("RETELL_MAX_WORKERS", "4"))
+# Re-read this much history before each number's watermark so calls that were
+# still in progress (no end_timestamp) on the previous run are picked up.
+WATERMARK_OVERLAP_MS = int(os.getenv("RETELL_WATERMARK_OVERLAP_MS", str(60 * 60 * 1000)))
+
+
+def get_allowed_numbers():
+    configured = os.getenv("RETELL_FROM_NUMBERS", "")
+    numbers = [n.strip() for n in configured.split(",") if n.strip()]
+    return numbers or DEFAULT_NUMBERS
+
+
+allowed_numbers = get_allowed_numbers()
+
+
+class RetellFetchError(Exception):
+    pass
+
+
+class SharedBackoff:
+    # One pause window shared by every worker: a 429 on any number holds back
+    # all requests until Retell's Retry-After (or our backoff) has passed.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocked_until = 0.0
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self._blocked_until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def penalize(self, seconds):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+def _watermark_key(number):
+    return f"retell_calls.{number}"
+
+
+def new_session(pool_size=MAX_WORKERS):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _post_with_retry(session, url, headers, payload, backoff, stats=None):
+    stats = stats or RunStats()
+    for attempt in range(5):
+        backoff.wait()
+        response = session.post(url, headers=headers, json=payload)
+        stats.add("api_calls")
+        if response.status_code == 200:
+            return response
+        elif response.status_code in [429, 500, 502, 503, 504]:
+            wait_time = float(response.headers.get("Retry-After", 2 ** attempt))
+            print(f"⚠️ API error {response.status_code}, retrying in {wait_time}s...")
+            stats.add("retries")
+            if response.status_code == 429:
+                backoff.penalize(wait_time)
+            else:
+                time.sleep(wait_time)
+        else:
+            raise RetellFetchError(f"Retell API error: {response.text}")
+    raise RetellFetchError(f"Retell API still failing after retries ({response.status_code})")
+
+
+def parse_calls_frame(call_list, number):
+    # Columnar parse of one page: the raw fields are collected once, then the
+    # timestamps, duration, cost and phone trimming run as vectorized column
+    # operations instead of building two pandas Timestamps per call. Calls the
+    # old per-call loop rejected (wrong from_number, missing timestamps,
+    # non-dict dynamic variables, non-string to_number) are dropped the same way.
+    calls = [c for c in call_list if isinstance(c, dict)]
+    variables = [c.get("retell_llm_dynamic_variables", {}) for c in calls]
+    raw = pd.DataFrame({
+        "from_number": [c.get("from_number", "") for c in calls],
+        "start_ms": [c.get("start_timestamp") for c in calls],
+        "end_ms": [c.get("end_timestamp") for c in calls],
+        "to_number": [c.get("to_number", "") for c in calls],
+        "email": [v.get("email") if isinstance(v, dict) else None for v in variables],
+        "title": [v.get("title") if isinstance(v, dict) else None for v in variables],
+        "valid_vars": [isinstance(v, dict) for v in variables],
+    }, columns=["from_number", "start_ms", "end_ms", "to_number", "email", "title", "valid_vars"])
+
+    raw = raw[raw["from_number"] == number]
+    start_ms = pd.to_numeric(raw["start_ms"], errors="coerce")
+    end_ms = pd.to_numeric(raw["end_ms"], errors="coerce")
+    has_times = start_ms.fillna(0).ne(0) & end_ms.fillna(0).ne(0)
+    is_str_number = raw["to_number"].map(lambda x: isinstance(x, str)).astype(bool)
+    malformed = has_times & ~(raw["valid_vars"].astype(bool) & is_str_number)
+    if malformed.any():
+        print(f"❌ Error parsing {int(malformed.sum())} call(s): malformed dynamic variables or to_number")
+    keep = has_times & ~malformed
+    raw, start_ms, end_ms = raw[keep], start_ms[keep], end_ms[keep]
+
+    start_dt = pd.to_datetime(start_ms, unit="ms")
+    end_dt = pd.to_datetime(end_ms, unit="ms")
+    duration_sec = (end_dt - start_dt).dt.total_seconds()
+    # Python round() per value keeps the stored cost identical to the old loop
+    total_cost = [round(x, 4) for x in (duration_sec.to_numpy() * 0.00234 * 85).tolist()]
+
+    to_number = raw["to_number"].astype(object)
+    trim = to_number.str.startswith("+91") & (to_number.str.len() > 3)
+    to_number = to_number.where(~trim, to_number.str[-10:])
+
+    return pd.DataFrame({
+        "email": raw["email"].to_numpy(dtype=object),
+        "StartTimestamp": start_dt.to_numpy(),
+        "EndTimestamp": end_dt.to_numpy(),
+        "TotalDurationSec": duration_sec.to_numpy(),
+        "TotalCost": total_cost,
+        "title": raw["title"].to_numpy(dtype=object),
+        "to_number": to_number.to_numpy(dtype=object),
+        "phone_key": normalize_phone_series(raw["to_number"]).to_numpy(dtype=object),
+    }, columns=CALL_COLUMNS)
+
+
+def parse_calls(call_list, number):
+    return parse_calls_frame(call_list, number).to_dict("records")
+
+
+def fetch_calls_for_number(number, retell_api_key, session=None, backoff=None, since_ms=None, stats=None):
+    # Returns (parsed calls frame, latest complete start_timestamp in ms). Pages
+    # newest-first with pagination_key until Retell runs out of calls or the
+    # page reaches since_ms.
+    url = f"{RETELL_API_BASE}/v2/list-calls"
     headers = {
         "Authorization": f"Bearer {retell_api_key}",
         "Content-Type": "application/json"
     }
+    session = session or new_session(1)
+    backoff = backoff or SharedBackoff()
 
+    filter_criteria = {"from_number": [number]}
+    if since_ms is not None:
+        filter_criteria["start_timestamp"] = {"lower_threshold": since_ms}
     payload = {
-        "limit": 1000,
-        "from_number": number
+        "limit": PAGE_LIMIT,
+        "sort_order": "descending",
+        "filter_criteria": filter_criteria
     }
 
-    for attempt in range(3):
-        response = requests.post(url, headers=headers, json=payload)
-        if response.status_code == 200:
-            break
-        elif response.status_code in [429, 500, 502, 503, 504]:
-            wait_time = 2 ** attempt
-            print(f"⚠️ API error {response.status_code}, retrying in {wait_time}s...")
-            time.sleep(wait_time)
-        else:
-            print(f"❌ Retell API error: {response.text}")
-            return []
-
-    try:
-        resp_json = response.json()
-    except Exception as e:
-        print(f"❌ JSON Decode Error: {e}")
-        return []
-
-    call_list = []
-    if isinstance(resp_json, list):
-        call_list = resp_json
-    elif isinstance(resp_json, dict):
-        call_list = resp_json.get("calls", [])
-    else:
-        print("❌ Unexpected API response format:", resp_json)
-        return []
-
-    parsed_data = []
-    for call in call_list:
+    frames = []
+    latest_ms = None
+    pages = 0
+    while True:
+        response = _post_with_retry(session, url, headers, payload, backoff, stats)
+        pages += 1
         try:
-            from_number = call.get("from_number", "")
-            if from_number != number:
-                continue
-            email = call.get("retell_llm_dynamic_variables", {}).get("email")
-            product_title = call.get("retell_llm_dynamic_variables", {}).get("title")
-            start_ms = call.get("start_timestamp")
-            end_ms = call.get("end_timestamp")
-            if not start_ms or not end_ms:
-                continue
-            start_dt = pd.to_datetime(start_ms, unit='ms')
-            end_dt = pd.to_datetime(end_ms, unit='ms')
-            duration_sec = (end_dt - start_dt).total_seconds()
-            total_cost = round(duration_sec * 0.00234 * 85, 4)
-
-            raw_to_number = call.get("to_number", "")
-            if raw_to_number.startswith("+91") and len(raw_to_number) > 3:
-                to_number = raw_to_number[-10:]
-            else:
-                to_number = raw_to_number
-
-            parsed_data.append({
-                "email": email,
-                "StartTimestamp": start_dt,
-                "EndTimestamp": end_dt,
-                "TotalDurationSec": duration_sec,
-                "TotalCost": total_cost,
-                "title": product_title,
-                "to_number": to_number
-            })
+            resp_json = response.json()
         except Exception as e:
-            print(f"❌ Error parsing call: {e}")
-            continue
+            raise RetellFetchError(f"JSON Decode Error: {e}")
+
+        if isinstance(resp_json, list):
+            call_list = resp_json
+        elif isinstance(resp_json, dict):
+            call_list = resp_json.get("calls", [])
+        else:
+            raise RetellFetchError(f"Unexpected API response format: {resp_json}")
+
+        frames.append(parse_calls_frame(call_list, number))
+        for call in call_list:
+            if call.get("end_timestamp") and call.get("start_timestamp"):
+                latest_ms = max(latest_ms or 0, call["start_timestamp"])
+
+        if len(call_list) < PAGE_LIMIT:
+            break
+        oldest_ms = min((c.get("start_timestamp") or 0) for c in call_list)
+        if since_ms is not None and oldest_ms < since_ms:
+            break
+        last_call_id = call_list[-1].get("call_id")
+        if not last_call_id:
+            break
+        payload["pagination_key"] = last_call_id
+
+    parsed = pd.concat(frames, ignore_index=True) if frames else parse_calls_frame([], number)
+    print(f"📞 {number}: {len(parsed)} calls from {pages} page(s)")
+    return parsed, latest_ms
 
-    return parsed_data
 
-def fetch_and_store_call_data():
+def fetch_and_store_call_data(full=False):
+    # Returns a stats dict (API calls, retries, rows fetched / written, DB
+    # round trips); "errors" counts numbers that could not be fetched.
+    stats = RunStats(api_calls=0, retries=0, fetched=0, written=0, failed=0, round_trips=0, errors=0)
     retell_api_key = os.getenv("RETELL_API_KEY")
     if not retell_api_key:
         print("❌ Missing RETELL_API_KEY in .env")
-        return
+        stats.add("errors")
+        return stats.as_dict()
 
-    all_data = []
+    conn = get_connection()
+    ensure_schema(conn)
+    watermarks = {}
+    since = {}
     for number in allowed_numbers:
-        print(f"Fetching calls for {number}...")
-        data = fetch_calls_for_number(number, retell_api_key)
-        all_data.extend(data)
+        watermark = None if full else get_watermark(conn, _watermark_key(number))
+        watermarks[number] = int(watermark) if watermark else 0
+        since[number] = watermarks[number] - WATERMARK_OVERLAP_MS if watermark else None
+
+    session = new_session(MAX_WORKERS)
+    backoff = SharedBackoff()
+    frames = {}
+    latest = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(allowed_numbers)))) as pool:
+        futures = {}
+        for number in allowed_numbers:
+            print(f"Fetching calls for {number}...")
+            futures[pool.submit(
+                fetch_calls_for_number, number, retell_api_key, session, backoff, since[number], stats
+            )] = number
+        for future in as_completed(futures):
+            number = futures[future]
+            try:
+                data, latest_ms = future.result()
+            except Exception as e:
+                print(f"❌ {number}: {e}")
+                stats.add("errors")
+                continue
+            frames[number] = data
+            if latest_ms:
+                latest[number] = latest_ms
 
-    if not all_data:
+    df = pd.concat(frames.values(), ignore_index=True) if frames else None
+    if df is None or df.empty:
         print("⚠️ No valid call records to store.")
-        return
+        conn.close()
+        return stats.as_dict()
+    stats.set("fetched", len(df))
 
-    df = pd.DataFrame(all_data)
     print("📋 Parsed call data preview:")
     print(df.head())
 
-    # Store in MySQL
-    conn = get_connection()
-    cursor = conn.cursor()
-    for _, row in df.iterrows():
-        try:
-            cursor.execute("""
-                INSERT INTO calls (email, StartTimestamp, EndTimestamp, TotalDurationSec, TotalCost, title, to_number)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                    EndTimestamp = VALUES(EndTimestamp),
-                    TotalDurationSec = VALUES(TotalDurationSec),
-                    TotalCost = VALUES(TotalCost),
-                    title = VALUES(title),
-                    to_number = VALUES(to_number)
-            """, (
-                row["email"], row["StartTimestamp"], row["EndTimestamp"],
-                row["TotalDurationSec"], row["TotalCost"], row["title"], row["to_number"]
-            ))
-        except Exception as e:
-            print(f"❌ DB insert failed: {e}")
-            continue
-    conn.commit()
-    cursor.close()
+    # Store in MySQL, one upsert per number: a number whose rows failed keeps
+    # its watermark, so the next run requests those calls again
+    for number, data in frames.items():
+        failed = 0
+        if not data.empty:
+            upsert_stats = bulk_upsert(
+                conn, "calls", CALL_COLUMNS, frame_to_rows(data, CALL_COLUMNS),
+                update_columns=["EndTimestamp", "TotalDurationSec", "TotalCost", "title", "to_number", "phone_key"],
+                label=f"calls {number}"
+            )
+            stats.add_upsert(upsert_stats)
+            failed = upsert_stats["failed"]
+        if failed:
+            print(f"⚠️ {number}: {failed} call(s) not stored, watermark held")
+        elif latest.get(number, 0) > watermarks[number]:
+            set_watermark(conn, _watermark_key(number), latest[number])
     conn.close()
     print("✅ Call data with TotalCallingCost stored in MySQL")
+    return stats.as_dict()
 
 if __name__ == "__main__":
-    fetch_and_store_call_data()
+    fetch_and_store_call_data(full="--full" in sys.argv[1:])
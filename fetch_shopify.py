@@ -1,89 +1,250 @@
 import requests
 import json
 import os
+import sys
+import time
+from datetime import datetime
 from dotenv import load_dotenv
 from db_connection import get_connection
+from db_bulk import bulk_upsert
+from discount_codes import replace_discount_codes
+from line_items import replace_line_items
+from phones import normalize_phone
+from run_stats import RunStats
+from schema import _column_exists, ensure_schema
+from sync_state import get_watermark, set_watermark
 
 load_dotenv()
 
-def fetch_and_store_shopify_orders():
-    store = os.getenv("SHOPIFY_STORE")
-    token = os.getenv("SHOPIFY_ACCESS_TOKEN")
+API_VERSION = "2023-01"
+PAGE_LIMIT = 250  # Shopify's maximum page size
+WATERMARK_KEY = "shopify_orders.updated_at"
+# A stored order only takes an incoming payload that is at least as new, so a
+# late webhook retry or a poll racing the receiver can't roll it back.
+NEWER_OR_SAME = "updated_at IS NULL OR VALUES(updated_at) >= updated_at"
+NEWER_CHECK_BATCH_SIZE = 500
+# line_items go to shopify_order_line_items (see line_items.py); title keeps
+# the first item's title for readers of the order row.
+ORDER_COLUMNS = [
+    "email", "order_number", "created_at", "total_price",
+    "discount_codes", "customer_first_name", "title", "phone", "updated_at", "phone_key"
+]
+# Whether shopify_orders still has the old line_items JSON column; looked up
+# once per process (restart the jobs after schema.py --drop-line-items-json).
+_has_line_items_json = None
 
-    print("DEBUG: SHOPIFY_STORE =", os.getenv("SHOPIFY_STORE"))
-    print("DEBUG: SHOPIFY_ACCESS_TOKEN =", "SET" if os.getenv("SHOPIFY_ACCESS_TOKEN") else "NOT SET")
 
-    url = f"https://{store}/admin/api/2023-01/orders.json"
+def order_to_row(order):
+    email = order.get("email") or None
+    order_number = order.get("order_number") or None
+    created_at = order.get("created_at") or None
+    updated_at = order.get("updated_at") or created_at
+    total_price = order.get("total_price") or "0"
+    discount_codes = json.dumps(order.get("discount_codes") or [])
+    customer_first_name = (
+        order.get("customer", {}).get("first_name") if order.get("customer") else None
+    )
+
+    line_items = order.get("line_items")
+    title = None
+    if isinstance(line_items, list) and len(line_items) > 0:
+        title = line_items[0].get("title")
+
+    # ✅ Robust phone extraction
+    phone = None
+    if order.get("billing_address") and order["billing_address"].get("phone"):
+        phone = order["billing_address"]["phone"]
+    elif order.get("phone"):
+        phone = order["phone"]
+
+    return (
+        email, order_number, created_at, total_price,
+        discount_codes, customer_first_name, title, phone, updated_at,
+        normalize_phone(phone)
+    )
+
+
+def _newer_stored(conn, rows):
+    # Order numbers whose stored row is newer than the payload in rows; their
+    # discount codes and line items are left alone too.
+    number_at = ORDER_COLUMNS.index("order_number")
+    updated_at = ORDER_COLUMNS.index("updated_at")
+    pairs = [(row[number_at], row[updated_at]) for row in rows if row[number_at] and row[updated_at]]
+    newer = set()
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(pairs), NEWER_CHECK_BATCH_SIZE):
+            batch = pairs[start:start + NEWER_CHECK_BATCH_SIZE]
+            conditions = " OR ".join(["(order_number = %s AND updated_at > %s)"] * len(batch))
+            cursor.execute(
+                f"SELECT order_number FROM shopify_orders WHERE {conditions}",
+                [value for pair in batch for value in pair]
+            )
+            newer.update(row[0] for row in cursor.fetchall())
+    finally:
+        cursor.close()
+    return newer
+
+
+def _line_items_json_column(conn):
+    global _has_line_items_json
+    if _has_line_items_json is None:
+        cursor = conn.cursor()
+        try:
+            _has_line_items_json = _column_exists(cursor, "shopify_orders", "line_items")
+        finally:
+            cursor.close()
+    return _has_line_items_json
+
+
+def store_orders(conn, orders):
+    # Returns the bulk_upsert() stats for the shopify_orders write; orders
+    # that could not be mapped to a row count as failed too.
+    rows = []
+    codes = []
+    items = []
+    skipped = 0
+    for order in orders:
+        try:
+            rows.append(order_to_row(order))
+            codes.append((order.get("order_number"), order.get("discount_codes")))
+            items.append((order.get("order_number"), order.get("line_items")))
+        except Exception as e:
+            skipped += 1
+            print(f"❌ Skipping order {order.get('order_number')} due to error: {e}")
+    if not rows:
+        return {"rows": skipped, "written": 0, "failed": skipped, "chunks": 0, "round_trips": 0}
+    columns = ORDER_COLUMNS
+    if _line_items_json_column(conn):
+        # Until the old JSON column is dropped, clear it so migrate_line_items
+        # never replaces these orders' rows with a stale blob
+        columns = ORDER_COLUMNS + ["line_items"]
+        rows = [row + (None,) for row in rows]
+    # updated_at last: the guard compares against the stored value
+    stats = bulk_upsert(
+        conn, "shopify_orders", columns, rows,
+        update_columns=[c for c in columns if c not in ("order_number", "updated_at")] + ["updated_at"],
+        guard=NEWER_OR_SAME
+    )
+    stats["rows"] += skipped
+    stats["failed"] += skipped
+    newer = _newer_stored(conn, rows)
+    if newer:
+        print(f"⏭️ Kept {len(newer)} stored order(s) newer than this payload")
+        codes = [c for c in codes if c[0] not in newer]
+        items = [i for i in items if i[0] not in newer]
+    # Codes parsed once here into order_discount_codes (see discount_codes.py)
+    replace_discount_codes(conn, codes)
+    replace_line_items(conn, items)
+    return stats
+
+
+def _get_with_retry(url, headers, params=None, stats=None):
+    stats = stats or RunStats()
+    for attempt in range(5):
+        response = requests.get(url, headers=headers, params=params)
+        stats.add("api_calls")
+        if response.status_code == 200:
+            return response
+        if response.status_code in [429, 500, 502, 503, 504]:
+            wait_time = float(response.headers.get("Retry-After", 2 ** attempt))
+            print(f"⚠️ Shopify API error {response.status_code}, retrying in {wait_time}s...")
+            stats.add("retries")
+            time.sleep(wait_time)
+        else:
+            break
+    print(f"❌ Shopify API error: {response.status_code}")
+    return None
+
+
+def iter_order_pages(store, token, updated_at_min=None, stats=None):
+    # Follows the cursor in the Link header (page_info) until Shopify stops
+    # returning rel="next". Filters can only be sent on the first request.
+    url = f"https://{store}/admin/api/{API_VERSION}/orders.json"
     params = {
         "status": "any",
-        "limit": 250  # Fetches the latest 250 orders
+        "limit": PAGE_LIMIT,
+        "order": "updated_at asc",
     }
+    if updated_at_min:
+        params["updated_at_min"] = updated_at_min
     headers = {"X-Shopify-Access-Token": token}
 
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code != 200:
-        print(f"❌ Shopify API error: {response.status_code}")
-        return
+    while url:
+        response = _get_with_retry(url, headers, params, stats)
+        if response is None:
+            raise RuntimeError("Shopify pagination aborted")
+        yield response.json().get("orders", [])
+        url = response.links.get("next", {}).get("url")
+        params = None  # the next-page URL already carries page_info and limit
+
 
-    orders = response.json().get("orders", [])
-    print(f"✅ Total orders fetched: {len(orders)}")
+def _later(a, b):
+    if not a:
+        return b
+    if not b:
+        return a
+    return a if datetime.fromisoformat(a) >= datetime.fromisoformat(b) else b
+
+
+def fetch_and_store_shopify_orders(full=False):
+    # Returns a stats dict like fetch_retell's; "errors" is set when
+    # pagination was aborted.
+    stats = RunStats(api_calls=0, retries=0, fetched=0, written=0, failed=0, round_trips=0, errors=0)
+    store = os.getenv("SHOPIFY_STORE")
+    token = os.getenv("SHOPIFY_ACCESS_TOKEN")
+
+    print("DEBUG: SHOPIFY_STORE =", os.getenv("SHOPIFY_STORE"))
+    print("DEBUG: SHOPIFY_ACCESS_TOKEN =", "SET" if os.getenv("SHOPIFY_ACCESS_TOKEN") else "NOT SET")
 
-    # Insert into DB
     conn = get_connection()
-    cursor = conn.cursor()
+    ensure_schema(conn)
 
-    for order in orders:
-        try:
-            email = order.get("email") or None
-            order_number = order.get("order_number") or None
-            created_at = order.get("created_at") or None
-            total_price = order.get("total_price") or "0"
-            discount_codes = json.dumps(order.get("discount_codes") or [])
-            customer_first_name = (
-                order.get("customer", {}).get("first_name") if order.get("customer") else None
-            )
+    watermark = None if full else get_watermark(conn, WATERMARK_KEY)
+    if watermark:
+        print(f"🔁 Incremental sync: orders updated since {watermark}")
+    else:
+        print("📥 No watermark found, running full backfill")
 
-            line_items = order.get("line_items")
-            title = None
-            if isinstance(line_items, list) and len(line_items) > 0:
-                title = line_items[0].get("title")
-
-            line_items_json = json.dumps(line_items)
-
-            # ✅ Robust phone extraction
-            phone = None
-            if order.get("billing_address") and order["billing_address"].get("phone"):
-                phone = order["billing_address"]["phone"]
-            elif order.get("phone"):
-                phone = order["phone"]
-
-            cursor.execute("""
-                INSERT INTO shopify_orders (
-                    email, order_number, created_at, total_price,
-                    discount_codes, customer_first_name, line_items, title, phone
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                    email = VALUES(email),
-                    created_at = VALUES(created_at),
-                    total_price = VALUES(total_price),
-                    discount_codes = VALUES(discount_codes),
-                    customer_first_name = VALUES(customer_first_name),
-                    line_items = VALUES(line_items),
-                    title = VALUES(title),
-                    phone = VALUES(phone)
-            """, (
-                email, order_number, created_at, total_price,
-                discount_codes, customer_first_name, line_items_json, title, phone
-            ))
+    total_fetched = 0
+    high_water = watermark
+    saved = watermark
+    held = False
+    try:
+        for orders in iter_order_pages(store, token, updated_at_min=watermark, stats=stats):
+            total_fetched += len(orders)
+            stats.set("fetched", total_fetched)
+            page_stats = store_orders(conn, orders)
+            stats.add_upsert(page_stats)
+            if page_stats["failed"] and not held:
+                # Pages come in updated_at order, so the watermark stops before
+                # this page and the next run re-requests its failed orders.
+                held = True
+                print(f"⚠️ {page_stats['failed']} order(s) not stored, watermark held at {high_water}")
+            if not held:
+                for order in orders:
+                    high_water = _later(high_water, order.get("updated_at") or order.get("created_at"))
+                # Checkpoint after every stored page, so a backfill that aborts
+                # late resumes from here instead of from the start
+                if high_water and high_water != saved:
+                    set_watermark(conn, WATERMARK_KEY, high_water)
+                    saved = high_water
+    except RuntimeError as e:
+        # Pages stored so far are kept, and the watermark stays at the last
+        # one; the next run re-requests everything after it.
+        print(f"❌ {e} after {total_fetched} orders, watermark kept at {saved}")
+        stats.add("errors")
+        conn.close()
+        return stats.as_dict()
 
-        except Exception as e:
-            print(f"❌ Skipping order {order.get('order_number')} due to error: {e}")
+    print(f"✅ Total orders fetched: {total_fetched}")
+    if saved != watermark:
+        print(f"🔖 Watermark advanced to {saved}")
 
-    conn.commit()
-    cursor.close()
     conn.close()
     print("✅ Shopify data stored in MySQL")
+    return stats.as_dict()
+
 
 if __name__ == "__main__":
-    fetch_and_store_shopify_orders()
+    fetch_and_store_shopify_orders(full="--full" in sys.argv[1:])
@@ -0,0 +1,69 @@
+import pandas as pd
+
+# Compact dtypes per table, applied once when a frame is loaded. Repeated
+# product names become categoricals, free-text identifiers Arrow-backed
+# strings, and timestamps datetime64.
+#
+# Read-only dashboard frames also narrow their measures to float32. Frames
+# the merge job writes back keep float64 measures, so costs and prices
+# round-trip to MySQL unchanged. Their titles stay Arrow strings, because
+# build_merged fills order titles from call titles and categoricals with
+# different categories can't be combined.
+
+ARROW_STRING = "string[pyarrow]"
+
+DASHBOARD_MERGED = {
+    "Email": ARROW_STRING,
+    "StartTimestamp": "datetime64[ns]",
+    "TotalDurationSec": "float32",
+    "TotalCost": "float32",
+    "order_number": "Int64",
+    "created_at": "datetime64[ns]",
+    "total_price": "float32",
+    "discount_codes": ARROW_STRING,
+    "customer_first_name": ARROW_STRING,
+    "title": "category",
+    "COGS": "float32",
+}
+
+MERGE_CALLS = {
+    "email": ARROW_STRING,
+    "StartTimestamp": "datetime64[ns]",
+    "title": ARROW_STRING,
+    "to_number": ARROW_STRING,
+    "phone_key": ARROW_STRING,
+}
+
+MERGE_ORDERS = {
+    "email": ARROW_STRING,
+    "created_at": "datetime64[ns]",
+    "discount_codes": ARROW_STRING,
+    "customer_first_name": ARROW_STRING,
+    "title": ARROW_STRING,
+    "phone": ARROW_STRING,
+    "phone_key": ARROW_STRING,
+}
+
+
+def apply_schema(df, schema):
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        if dtype.startswith("datetime64"):
+            df[column] = pd.to_datetime(df[column], errors="coerce")
+        elif dtype.startswith(("float", "int", "Int")):
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def frame_memory(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
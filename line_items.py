@@ -0,0 +1,97 @@
+import json
+from db_bulk import replace_order_rows
+from db_connection import read_sql
+
+# Shopify line items, one row per product per order in shopify_order_line_items
+# (see schema.py) instead of a JSON blob on every shopify_orders row. Variants
+# of the same product are folded into one row with their quantities summed, so
+# merge_new can join and price COGS per product. fetch_shopify writes the rows
+# at ingest and clears the order's blob while the column exists;
+# migrate_line_items() moves the blobs of older orders across.
+
+LINE_ITEM_COLUMNS = ["order_number", "title", "quantity", "price"]
+ORDER_BATCH_SIZE = 1000
+
+
+def line_item_rows(order_number, line_items):
+    # line_items: the API list, or the JSON text older rows stored
+    if isinstance(line_items, str):
+        try:
+            line_items = json.loads(line_items)
+        except ValueError:
+            return []
+    if order_number is None or not isinstance(line_items, list):
+        return []
+    products = {}
+    for item in line_items:
+        if not isinstance(item, dict):
+            continue
+        title = str(item.get("title") or "").strip()[:255]
+        if not title:
+            continue
+        try:
+            quantity = int(item.get("quantity") or 1)
+        except (TypeError, ValueError):
+            quantity = 1
+        if title in products:
+            products[title][0] += quantity
+        else:
+            products[title] = [quantity, item.get("price")]
+    return [(order_number, title, quantity, price) for title, (quantity, price) in products.items()]
+
+
+def replace_line_items(conn, orders):
+    # orders: (order_number, line_items) pairs; each order's rows are replaced
+    # so items removed by an order edit disappear too.
+    order_numbers = []
+    rows = []
+    for order_number, line_items in orders:
+        if order_number is None:
+            continue
+        order_numbers.append(order_number)
+        rows.extend(line_item_rows(order_number, line_items))
+    return replace_order_rows(
+        conn, "shopify_order_line_items", LINE_ITEM_COLUMNS, order_numbers, rows,
+        update_columns=["quantity", "price"], batch_size=ORDER_BATCH_SIZE
+    )
+
+
+def migrate_line_items(conn, drop_json=False):
+    # One-off move of the stored line_items JSON into shopify_order_line_items,
+    # batch by batch: each batch's blobs are cleared once its rows are written,
+    # so an interrupted migration just picks up where it stopped. Orders that
+    # already have rows were stored since the split, so their blob is stale
+    # and only cleared.
+    orders = 0
+    written = 0
+    cursor = conn.cursor()
+    try:
+        while True:
+            batch = read_sql(
+                "SELECT o.order_number, o.line_items, EXISTS ("
+                "   SELECT 1 FROM shopify_order_line_items li WHERE li.order_number = o.order_number"
+                " ) AS migrated"
+                " FROM shopify_orders o"
+                " WHERE o.line_items IS NOT NULL ORDER BY o.order_number LIMIT %s",
+                params=[ORDER_BATCH_SIZE]
+            )
+            if batch.empty:
+                break
+            pending = batch.loc[batch["migrated"] == 0, ["order_number", "line_items"]]
+            written += replace_line_items(conn, pending.itertuples(index=False, name=None))
+            order_numbers = [int(o) for o in batch["order_number"]]
+            placeholders = ", ".join(["%s"] * len(order_numbers))
+            cursor.execute(
+                f"UPDATE shopify_orders SET line_items = NULL WHERE order_number IN ({placeholders})",
+                order_numbers
+            )
+            conn.commit()
+            orders += len(batch)
+        print(f"🛠️ Moved line items of {orders} orders into shopify_order_line_items ({written} rows)")
+        if drop_json:
+            cursor.execute("ALTER TABLE shopify_orders DROP COLUMN line_items")
+            conn.commit()
+            print("🛠️ Dropped shopify_orders.line_items")
+    finally:
+        cursor.close()
+    return {"orders": orders, "written": written}
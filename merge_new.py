@@ -1,25 +1,113 @@
+import argparse
+import multiprocessing
+import os
+import sys
 import pandas as pd
-from db_connection import get_connection
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from db_connection import format_pool_stats, get_connection, read_sql
+from attribution import refresh_attributed_purchases
+from cogs_catalog import load_catalog
+from db_bulk import bulk_upsert, frame_to_rows
+from discount_codes import sync_discount_codes
+from frame_types import MERGE_CALLS, MERGE_ORDERS, apply_schema, format_bytes, frame_memory
+from phones import normalize_phone_series
+from schema import ensure_schema
+from rollups import refresh_daily_rollups
+from run_stats import RunStats
+from sync_state import bump_data_version, get_watermark, set_watermark
 
-def merge_data():
-    conn = get_connection()
+# Both watermarks are on ingested_at (when the row was written to MySQL), so a
+# call or order that arrives late is still re-joined. Bounds are inclusive on
+# the lower end: ingested_at has one-second resolution, and re-joining a row
+# twice is harmless.
+CALLS_WATERMARK_KEY = "merge.calls.ingested_at"
+ORDERS_WATERMARK_KEY = "merge.shopify_orders.ingested_at"
+PHONE_BATCH_SIZE = 1000
+# > 1 streams a full rebuild through that many phone-hash partitions so peak
+# memory follows partition size instead of total history.
+MERGE_PARTITIONS = int(os.getenv("MERGE_PARTITIONS", "1"))
+# > 1 joins the partitions of a full rebuild in that many worker processes
+# (0 = one per CPU core).
+MERGE_WORKERS = int(os.getenv("MERGE_WORKERS", "1"))
+# merge_data runs under a MySQL named lock, so the pipeline's merge and the
+# webhook receiver's never interleave; a second caller waits this many seconds.
+MERGE_LOCK_NAME = "merge_data"
+MERGE_LOCK_TIMEOUT = int(os.getenv("MERGE_LOCK_TIMEOUT", "900"))
+
+# Only the columns the join and merged_data need. Orders come back one row per
+# product (see line_items.py); orders with no stored line items keep the
+# order-level title with quantity 1.
+CALL_READ_COLUMNS = ["email", "StartTimestamp", "TotalDurationSec", "TotalCost", "title", "to_number", "phone_key"]
+ORDER_READ_COLUMNS = [
+    "o.email", "o.order_number", "o.created_at", "o.total_price", "o.discount_codes",
+    "o.customer_first_name", "COALESCE(li.title, o.title) AS title",
+    "COALESCE(li.quantity, 1) AS quantity", "o.phone", "o.phone_key"
+]
+CALLS_SELECT = f"SELECT {', '.join(CALL_READ_COLUMNS)} FROM calls"
+ORDERS_SELECT = (
+    f"SELECT {', '.join(ORDER_READ_COLUMNS)} FROM shopify_orders o"
+    " LEFT JOIN shopify_order_line_items li ON li.order_number = o.order_number"
+)
+
+MERGED_COLUMNS = [
+    "Email", "StartTimestamp", "TotalDurationSec", "TotalCost",
+    "order_number", "created_at", "total_price", "discount_codes",
+    "customer_first_name", "title", "COGS"
+]
+MERGED_UPDATE_COLUMNS = [
+    "Email", "StartTimestamp", "TotalDurationSec", "TotalCost",
+    "created_at", "total_price", "discount_codes", "customer_first_name", "COGS"
+]
+# What write_merged reads from a build_merged() frame
+WRITE_INPUT_COLUMNS = ["email_x", "email_y"] + [c for c in MERGED_COLUMNS if c != "Email"]
+
+
+def _pick_email(df_merged):
+    # Order email first, call email as fallback, "NA" when neither is usable
+    order_email = df_merged["email_x"]
+    has_order_email = order_email.notna() & order_email.astype(str).str.strip().ne("")
+    email = order_email.where(has_order_email, df_merged["email_y"])
+    has_email = email.notna() & email.astype(str).str.strip().ne("")
+    return email.where(has_email, "NA")
 
-    # Load data from DB
-    df_calls = pd.read_sql("SELECT * FROM calls", conn)
-    df_orders = pd.read_sql("SELECT * FROM shopify_orders", conn)
 
+def write_merged(conn, df_merged):
+    if df_merged.empty:
+        return {"rows": 0, "written": 0, "failed": 0, "chunks": 0, "round_trips": 0}
+    out = df_merged.assign(Email=_pick_email(df_merged))
+    return bulk_upsert(
+        conn, "merged_data", MERGED_COLUMNS, frame_to_rows(out, MERGED_COLUMNS),
+        update_columns=MERGED_UPDATE_COLUMNS
+    )
+
+
+def build_merged(df_calls, df_orders, catalog):
     # Normalize column names
     df_calls.columns = df_calls.columns.str.strip()
     df_orders.columns = df_orders.columns.str.strip()
 
+    # Compact dtypes (see frame_types.py)
+    memory_before = frame_memory(df_calls) + frame_memory(df_orders)
+    apply_schema(df_calls, MERGE_CALLS)
+    apply_schema(df_orders, MERGE_ORDERS)
+    print(f"🧠 Calls + orders in memory: {format_bytes(memory_before)} → "
+          f"{format_bytes(frame_memory(df_calls) + frame_memory(df_orders))}")
+
     # Basic cleanup
-    df_orders["created_at"] = pd.to_datetime(df_orders["created_at"], errors="coerce")
     df_orders["order_date"] = df_orders["created_at"].dt.date
     df_orders["price"] = pd.to_numeric(df_orders["total_price"], errors="coerce").fillna(0)
 
-    # Clean and normalize phone numbers for joining
-    df_calls["to_number"] = df_calls["to_number"].astype(str).str.replace(r"\D", "", regex=True).str[-10:]
-    df_orders["phone"] = df_orders["phone"].astype(str).str.replace(r"\D", "", regex=True).str[-10:]
+    # Join on the phone_key stored at ingest (see phones.py); it is only
+    # computed here for frames that don't carry it. Rows without a usable
+    # phone can't be attributed and are left out of the join.
+    if "phone_key" not in df_calls.columns:
+        df_calls["phone_key"] = normalize_phone_series(df_calls["to_number"])
+    if "phone_key" not in df_orders.columns:
+        df_orders["phone_key"] = normalize_phone_series(df_orders["phone"])
+    if "quantity" not in df_orders.columns:
+        df_orders["quantity"] = 1
+    df_calls = df_calls[df_calls["phone_key"].notna()].assign(to_number=lambda d: d["phone_key"]).drop(columns="phone_key")
+    df_orders = df_orders[df_orders["phone_key"].notna()].assign(phone=lambda d: d["phone_key"]).drop(columns="phone_key")
 
     # Merge on phone = to_number
     df_merged = pd.merge(
@@ -32,69 +120,291 @@ def merge_data():
 
     # Prioritize title from orders table, fallback to calls table
     df_merged["title"] = df_merged["title_x"].fillna(df_merged["title_y"])
-    df_merged["title_clean"] = df_merged["title"].astype(str).str.strip().str.lower()
 
-    # Merge with COGS
-    try:
-        cogs_df = pd.read_sql("SELECT * FROM product_cogs", conn)
-        cogs_df["product_title_clean"] = cogs_df["product_title"].astype(str).str.strip().str.lower()
-        df_merged = df_merged.merge(
-            cogs_df[["product_title_clean", "cogs"]],
-            left_on="title_clean",
-            right_on="product_title_clean",
-            how="left"
-        )
-        df_merged["COGS"] = pd.to_numeric(df_merged["cogs"], errors="coerce").fillna(0)
-    except Exception as e:
-        print(f"⚠️ DB COGS merge error: {e}")
+    # COGS from the catalog index (see cogs_catalog.py): unit COGS times the
+    # line item's quantity
+    if catalog is not None:
+        quantity = pd.to_numeric(df_merged["quantity"], errors="coerce").fillna(1)
+        df_merged["COGS"] = catalog.cogs_for(df_merged["title"]) * quantity
+    else:
         df_merged["COGS"] = 0
 
-    # Deduplicate to keep only one unique record per product per order per phone
-    df_merged = df_merged.sort_values(by=["phone", "order_number", "created_at"], ascending=[True, True, False])
+    # Deduplicate to keep only one unique record per product per order per phone:
+    # the earliest call made before the order (the one attribution.py credits),
+    # or the earliest call at all when none was. Calls made at the same moment
+    # to the same phone (to_number is the phone_key by now) are ordered by
+    # their own duration, cost, email and title, so every run, input order and
+    # partition layout keeps the same call.
+    df_merged["call_after_order"] = ~(df_merged["StartTimestamp"] <= df_merged["created_at"])
+    df_merged = df_merged.sort_values(
+        by=[
+            "phone", "order_number", "created_at", "call_after_order", "StartTimestamp",
+            "TotalDurationSec", "TotalCost", "email_y", "title_y"
+        ],
+        ascending=[True, True, False, True, True, True, True, True, True],
+        kind="mergesort"
+    )
     df_merged = df_merged.drop_duplicates(subset=["phone", "order_number", "title"], keep="first")
+    return df_merged
+
+
+def _read_for_phones(query, phone_keys):
+    frames = []
+    keys = sorted(phone_keys)
+    for start in range(0, len(keys), PHONE_BATCH_SIZE):
+        batch = keys[start:start + PHONE_BATCH_SIZE]
+        placeholders = ", ".join(["%s"] * len(batch))
+        frames.append(read_sql(
+            f"{query} WHERE phone_key IN ({placeholders})",
+            params=batch
+        ))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def _signature(df):
+    # Type-insensitive fingerprint of the merged_data columns, so rows read back
+    # from MySQL compare equal to freshly built ones.
+    parts = []
+    for column in MERGED_COLUMNS:
+        values = df[column]
+        if column in ("StartTimestamp", "created_at"):
+            values = pd.to_datetime(values, errors="coerce").dt.strftime("%Y-%m-%d %H:%M:%S")
+        elif column in ("TotalDurationSec", "TotalCost", "total_price", "COGS"):
+            values = pd.to_numeric(values, errors="coerce").round(4).astype(str)
+        parts.append(values.astype(str).where(values.notna(), ""))
+    signature = parts[0]
+    for part in parts[1:]:
+        signature = signature + "\x1f" + part
+    return signature
+
+
+def _drop_unchanged(df_merged):
+    order_numbers = df_merged["order_number"].dropna().unique().tolist()
+    existing = []
+    for start in range(0, len(order_numbers), PHONE_BATCH_SIZE):
+        batch = order_numbers[start:start + PHONE_BATCH_SIZE]
+        placeholders = ", ".join(["%s"] * len(batch))
+        existing.append(read_sql(
+            f"SELECT {', '.join(MERGED_COLUMNS)} FROM merged_data WHERE order_number IN ({placeholders})",
+            params=batch
+        ))
+    if not existing:
+        return df_merged, pd.DataFrame(columns=MERGED_COLUMNS)
+    existing = pd.concat(existing, ignore_index=True)
+    candidate = df_merged.assign(Email=_pick_email(df_merged))
+    changed = ~_signature(candidate).isin(set(_signature(existing)))
+    return df_merged[changed.to_numpy()], existing
 
-    # Insert into merged_data table
-    # Insert into merged_data table
+
+def _current_high_water(conn):
     cursor = conn.cursor()
-    for _, row in df_merged.iterrows():
-        try:
-            # email = row.get("email")
-            email = row.get("email_x") if pd.notna(row.get("email_x")) and str(row.get("email_x")).strip() else row.get("email_y")
-            if pd.isna(email) or not str(email).strip():
-                email = "NA"
-
-            values = tuple(None if pd.isna(x) else x for x in [
-                email, row.get("StartTimestamp"),
-                row.get("TotalDurationSec"), row.get("TotalCost"),
-                row.get("order_number"), row.get("created_at"), row.get("total_price"),
-                row.get("discount_codes"), row.get("customer_first_name"),
-                row.get("title"), row.get("COGS")
-            ])
-            cursor.execute("""
-                INSERT INTO merged_data (
-                    Email, StartTimestamp, TotalDurationSec, TotalCost,
-                    order_number, created_at, total_price, discount_codes,
-                    customer_first_name, title, COGS
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                    Email = VALUES(Email),
-                    StartTimestamp = VALUES(StartTimestamp),
-                    TotalDurationSec = VALUES(TotalDurationSec),
-                    TotalCost = VALUES(TotalCost),
-                    created_at = VALUES(created_at),
-                    total_price = VALUES(total_price),
-                    discount_codes = VALUES(discount_codes),
-                    customer_first_name = VALUES(customer_first_name),
-                    COGS = VALUES(COGS)
-            """, values)
-
-        except Exception as e:
-            print(f"⚠️ Skipping row due to error: {e}")
-
-    conn.commit()
+    cursor.execute("SELECT MAX(ingested_at) FROM calls")
+    calls_max = cursor.fetchone()[0]
+    cursor.execute("SELECT MAX(ingested_at) FROM shopify_orders")
+    orders_max = cursor.fetchone()[0]
     cursor.close()
-    conn.close()
+    return calls_max, orders_max
+
+
+def _call_days(values):
+    return set(pd.to_datetime(values, errors="coerce").dropna().dt.date)
+
+
+def _changed_phone_keys(calls_since, calls_until, orders_since, orders_until):
+    # The call days come from the calls themselves, so a late call refreshes
+    # the rollup of the day it was made on.
+    new_calls = read_sql(
+        "SELECT phone_key, StartTimestamp FROM calls WHERE ingested_at >= %s AND ingested_at <= %s",
+        params=[calls_since, calls_until]
+    )
+    changed_orders = read_sql(
+        "SELECT phone_key FROM shopify_orders WHERE ingested_at >= %s AND ingested_at <= %s",
+        params=[orders_since, orders_until]
+    )
+    keys = set(new_calls["phone_key"].dropna())
+    keys.update(changed_orders["phone_key"].dropna())
+    print(f"🔁 {len(new_calls)} new calls, {len(changed_orders)} new/changed orders, {len(keys)} phone numbers to re-join")
+    return keys, _call_days(new_calls["StartTimestamp"])
+
+
+def _read_partition(partitions, partition):
+    # Hash of the stored phone_key, computed in MySQL, so every call and order
+    # for a phone lands in the same partition and each one joins and dedups
+    # on its own.
+    params = (partitions, partition)
+    df_calls = read_sql(
+        f"{CALLS_SELECT} WHERE phone_key IS NOT NULL AND MOD(CRC32(phone_key), %s) = %s",
+        params=params
+    )
+    df_orders = read_sql(
+        f"{ORDERS_SELECT} WHERE phone_key IS NOT NULL AND MOD(CRC32(phone_key), %s) = %s",
+        params=params
+    )
+    return df_calls, df_orders
+
+
+def _iter_partitions(partitions):
+    for partition in range(partitions):
+        yield _read_partition(partitions, partition)
+
+
+_worker_catalog = None
+
+
+def _init_worker(catalog):
+    # Pool initializer: every worker gets the catalog the parent loaded, so the
+    # checksum / cache round isn't repeated once per process.
+    global _worker_catalog
+    _worker_catalog = catalog
+
+
+def _merge_partition(partitions, partition):
+    # Runs in a worker process: read, join, COGS-enrich and dedup one
+    # partition, and send back only the columns write_merged needs.
+    df_calls, df_orders = _read_partition(partitions, partition)
+    df_merged = build_merged(df_calls, df_orders, _worker_catalog)
+    return partition, len(df_calls), len(df_orders), df_merged[WRITE_INPUT_COLUMNS]
+
+
+def _merge_parallel(conn, partitions, workers, stats):
+    # spawn, not fork: a forked child would inherit the parent's pooled MySQL
+    # connections. Each worker opens its own engine on first use.
+    context = multiprocessing.get_context("spawn")
+    catalog = load_catalog()
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(catalog,)
+    ) as pool:
+        futures = [pool.submit(_merge_partition, partitions, p) for p in range(partitions)]
+        for future in as_completed(futures):
+            partition, calls_count, orders_count, df_merged = future.result()
+            print(f"🧩 Partition {partition + 1}/{partitions}: {calls_count} calls, {orders_count} orders, {len(df_merged)} merged rows")
+            stats.add("merged_rows", len(df_merged))
+            stats.add_upsert(write_merged(conn, df_merged))
+
+
+def _acquire_merge_lock(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MERGE_LOCK_NAME, MERGE_LOCK_TIMEOUT))
+        acquired = cursor.fetchone()[0] == 1
+    finally:
+        cursor.close()
+    if not acquired:
+        raise RuntimeError(f"Another merge still holds the '{MERGE_LOCK_NAME}' lock after {MERGE_LOCK_TIMEOUT}s")
+
+
+def _release_merge_lock(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (MERGE_LOCK_NAME,))
+        cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def merge_data(full=False, partitions=None, workers=None):
+    partitions = partitions or MERGE_PARTITIONS
+    workers = MERGE_WORKERS if workers is None else workers
+    workers = workers or os.cpu_count() or 1
+    if workers > 1:
+        partitions = max(partitions, workers)
+    # Returns a stats dict: merged rows, rows written, DB round trips
+    conn = get_connection()
+    try:
+        ensure_schema(conn)
+        # The lock is per session, so it is released before the connection
+        # goes back to the pool
+        _acquire_merge_lock(conn)
+        try:
+            return _merge(conn, full, partitions, workers)
+        finally:
+            _release_merge_lock(conn)
+    finally:
+        conn.close()
+
+
+def _merge(conn, full, partitions, workers):
+    stats = RunStats(merged_rows=0, written=0, failed=0, round_trips=0)
+    calls_since = None if full else get_watermark(conn, CALLS_WATERMARK_KEY)
+    orders_since = None if full else get_watermark(conn, ORDERS_WATERMARK_KEY)
+    calls_until, orders_until = _current_high_water(conn)
+    incremental = calls_since is not None and orders_since is not None
+
+    # order_discount_codes for orders stored before it existed or changed
+    # since its own watermark (fetch_shopify fills it at ingest)
+    stats.set("discount_code_orders", sync_discount_codes(conn, until=orders_until, full=full)["orders"])
+
+    if incremental:
+        phone_keys, touched_days = _changed_phone_keys(calls_since, calls_until, orders_since, orders_until)
+        if not phone_keys:
+            print("✅ Merged data already up to date")
+            return stats.as_dict()
+        # Pull every call / order that shares a phone with a changed row so the
+        # join and dedup see the same rows a full rebuild would for that phone.
+        df_calls = _read_for_phones(CALLS_SELECT, phone_keys)
+        df_orders = _read_for_phones(ORDERS_SELECT, phone_keys)
+        df_merged = build_merged(df_calls, df_orders, load_catalog())
+        before = len(df_merged)
+        df_merged, existing = _drop_unchanged(df_merged)
+        print(f"🔁 {len(df_merged)} of {before} re-joined rows changed")
+        touched_days |= _call_days(df_merged["StartTimestamp"])
+        touched_days |= _call_days(existing["StartTimestamp"])
+        stats.add("merged_rows", len(df_merged))
+
+        # Insert into merged_data table
+        stats.add_upsert(write_merged(conn, df_merged))
+
+        # Re-attribute the orders whose merged rows changed
+        changed_orders = set(df_merged["order_number"].dropna()) | set(existing["order_number"].dropna())
+        touched_days |= refresh_attributed_purchases(conn, changed_orders)
+    elif workers > 1:
+        print(f"📥 Full rebuild of merged_data, {partitions} phone partitions on {workers} worker processes")
+        _merge_parallel(conn, partitions, workers, stats)
+    elif partitions > 1:
+        print(f"📥 Full rebuild of merged_data, streaming {partitions} phone partitions")
+        catalog = load_catalog()
+        for partition, (df_calls, df_orders) in enumerate(_iter_partitions(partitions)):
+            df_merged = build_merged(df_calls, df_orders, catalog)
+            print(f"🧩 Partition {partition + 1}/{partitions}: {len(df_calls)} calls, {len(df_orders)} orders, {len(df_merged)} merged rows")
+            stats.add("merged_rows", len(df_merged))
+            stats.add_upsert(write_merged(conn, df_merged))
+            del df_calls, df_orders, df_merged
+    else:
+        print("📥 Full rebuild of merged_data")
+        # Load data from DB
+        df_calls = read_sql(CALLS_SELECT)
+        df_orders = read_sql(ORDERS_SELECT)
+        df_merged = build_merged(df_calls, df_orders, load_catalog())
+        stats.add("merged_rows", len(df_merged))
+
+        # Insert into merged_data table
+        stats.add_upsert(write_merged(conn, df_merged))
+
+    if not incremental:
+        refresh_attributed_purchases(conn)
+
+    # Daily rollups: only the call dates this run touched, or all of them on a rebuild
+    refresh_daily_rollups(conn, touched_days if incremental else None)
+
+    if calls_until is not None:
+        set_watermark(conn, CALLS_WATERMARK_KEY, calls_until)
+    if orders_until is not None:
+        set_watermark(conn, ORDERS_WATERMARK_KEY, orders_until)
+    bump_data_version(conn)
+
+    print(format_pool_stats())
     print("✅ Merged data (joined on phone ↔ to_number) stored in MySQL")
+    return stats.as_dict()
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="Join calls and Shopify orders into merged_data")
+    parser.add_argument("--full", action="store_true", help="rebuild merged_data instead of merging only new/changed rows")
+    parser.add_argument("--partitions", type=int, default=None, help="stream a full rebuild through N phone-hash partitions")
+    parser.add_argument("--workers", type=int, default=None, help="join partitions in N processes (0 = all cores)")
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    merge_data()
+    args = _parse_args(sys.argv[1:])
+    merge_data(full=args.full, partitions=args.partitions, workers=args.workers)
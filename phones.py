@@ -0,0 +1,22 @@
+import re
+
+# Join key shared by calls.to_number and shopify_orders.phone: the last 10
+# digits of the number, or None when it has no digits at all. Computed once at
+# ingest and stored in the indexed phone_key columns.
+
+_NON_DIGITS = re.compile(r"[^0-9]")
+
+# Same rule evaluated inside MySQL, for backfilling existing rows
+PHONE_KEY_SQL = "NULLIF(RIGHT(REGEXP_REPLACE({column}, '[^0-9]', ''), 10), '')"
+
+
+def normalize_phone(value):
+    if value is None:
+        return None
+    digits = _NON_DIGITS.sub("", str(value))
+    return digits[-10:] or None
+
+
+def normalize_phone_series(values):
+    keys = values.astype(str).str.replace(r"[^0-9]", "", regex=True).str[-10:]
+    return keys.where(values.notna() & keys.ne(""), None)
@@ -0,0 +1,207 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from db_connection import format_pool_stats, get_connection, pool_stats
+from fetch_retell import fetch_and_store_call_data
+from fetch_shopify import fetch_and_store_shopify_orders
+from merge_new import merge_data
+from schema import ensure_schema
+
+load_dotenv()
+
+# One process for the whole sync: the Retell and Shopify fetches run side by
+# side, then the merge. Every invocation is a new run in pipeline_runs, one row
+# per stage with its wall time and the stats dict its job returns. The fetches
+# always run (their watermarks keep them incremental). The merge is held back
+# when a fetch crashed, unless the previous run's merge failed or was held
+# back too: then it is re-run on what is already stored, which is the only
+# thing a later run resumes.
+
+METRICS_PATH = os.getenv("PIPELINE_METRICS_PATH", "pipeline_runs.json")
+PROM_TEXTFILE = os.getenv("PIPELINE_PROM_TEXTFILE")  # e.g. for node_exporter's textfile collector
+
+FETCH_STAGES = ["fetch_retell", "fetch_shopify"]
+
+
+def _now():
+    return datetime.datetime.now().replace(microsecond=0)
+
+
+def _new_run_id():
+    # Unique per invocation, so a run never overwrites an earlier one's rows
+    return f"{_now():%Y%m%dT%H%M%S}-{os.getpid()}"
+
+
+def _pending_merge(conn):
+    # run_id of the latest recorded merge if it didn't finish, else None
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT run_id, status FROM pipeline_runs
+            WHERE stage = 'merge' ORDER BY started_at DESC LIMIT 1
+        """)
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    return row[0] if row and row[1] != "done" else None
+
+
+def _start_stage(conn, run_id, stage, status="running"):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "INSERT INTO pipeline_runs (run_id, stage, status, started_at) VALUES (%s, %s, %s, %s)",
+            (run_id, stage, status, _now())
+        )
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def _finish_stage(conn, run_id, record):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE pipeline_runs
+            SET status = %s, started_at = %s, finished_at = %s, duration_sec = %s, metrics = %s, error = %s
+            WHERE run_id = %s AND stage = %s
+        """, (
+            record["status"], record["started_at"], record["finished_at"], record["duration_sec"],
+            json.dumps(record["metrics"] or {}, default=str), record["error"], run_id, record["stage"]
+        ))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def _run_stage(stage, job):
+    # "raised" separates a crashed stage (later stages are held back) from one
+    # whose job finished but reported errors (the merge still runs on what was
+    # stored, as it did when the workflow ran the scripts one by one).
+    record = {"stage": stage, "started_at": _now(), "metrics": {}, "error": None, "raised": False}
+    start = time.perf_counter()
+    try:
+        record["metrics"] = job() or {}
+        errors = record["metrics"].get("errors", 0)
+        record["status"] = "failed" if errors else "done"
+        if errors:
+            record["error"] = f"{errors} error(s) reported"
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"{type(e).__name__}: {e}"
+        record["raised"] = True
+    record["duration_sec"] = round(time.perf_counter() - start, 3)
+    record["finished_at"] = _now()
+    icon = "✅" if record["status"] == "done" else "❌"
+    print(f"{icon} Stage {stage}: {record['status']} in {record['duration_sec']}s {record['metrics']}"
+          + (f" ({record['error']})" if record["error"] else ""))
+    return record
+
+
+def _write_metrics_json(run):
+    history = []
+    if os.path.exists(METRICS_PATH):
+        with open(METRICS_PATH) as f:
+            history = json.load(f)
+    history.append(run)
+    with open(METRICS_PATH, "w") as f:
+        json.dump(history, f, indent=2, default=str)
+
+
+def _write_prom_textfile(run):
+    lines = [
+        "# TYPE pipeline_last_run_timestamp_seconds gauge",
+        f"pipeline_last_run_timestamp_seconds {time.time():.0f}",
+        "# TYPE pipeline_stage_success gauge",
+        "# TYPE pipeline_stage_duration_seconds gauge",
+    ]
+    for record in run["stages"]:
+        label = f'{{stage="{record["stage"]}"}}'
+        lines.append(f"pipeline_stage_success{label} {int(record['status'] == 'done')}")
+        lines.append(f"pipeline_stage_duration_seconds{label} {record['duration_sec']}")
+        for key, value in record["metrics"].items():
+            if isinstance(value, (int, float)):
+                lines.append(f"pipeline_stage_{key}{label} {value}")
+    tmp_path = f"{PROM_TEXTFILE}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, PROM_TEXTFILE)
+
+
+def run_pipeline(full=False, partitions=None, workers=None):
+    conn = get_connection()
+    ensure_schema(conn)
+
+    run_id = _new_run_id()
+    pending_merge = _pending_merge(conn)
+    print(f"🚀 Pipeline run {run_id}")
+
+    run_start = time.perf_counter()
+    records = []
+    jobs = {
+        "fetch_retell": lambda: fetch_and_store_call_data(full=full),
+        "fetch_shopify": lambda: fetch_and_store_shopify_orders(full=full),
+    }
+    with ThreadPoolExecutor(max_workers=len(FETCH_STAGES)) as pool:
+        futures = []
+        for stage in FETCH_STAGES:
+            _start_stage(conn, run_id, stage)
+            futures.append(pool.submit(_run_stage, stage, jobs[stage]))
+        for future in as_completed(futures):
+            record = future.result()
+            _finish_stage(conn, run_id, record)
+            records.append(record)
+
+    fetch_raised = any(record["raised"] for record in records)
+    resumed = fetch_raised and pending_merge is not None
+    held_back = fetch_raised and not resumed
+    if held_back:
+        _start_stage(conn, run_id, "merge", status="held")
+        print("⏸️ Merge held back until the failed fetch succeeds")
+    else:
+        if resumed:
+            print(f"↩️ Re-running the merge that run {pending_merge} didn't finish, on the data already stored")
+        _start_stage(conn, run_id, "merge")
+        record = _run_stage("merge", lambda: merge_data(full=full, partitions=partitions, workers=workers))
+        _finish_stage(conn, run_id, record)
+        records.append(record)
+
+    run = {
+        "run_id": run_id,
+        "resumed_merge_of": pending_merge if resumed else None,
+        "finished_at": _now(),
+        "duration_sec": round(time.perf_counter() - run_start, 3),
+        "stages": [{k: v for k, v in r.items() if k != "raised"} for r in records],
+        "db_pool": pool_stats(),
+    }
+    conn.close()
+    _write_metrics_json(run)
+    if PROM_TEXTFILE:
+        _write_prom_textfile(run)
+    print(format_pool_stats())
+
+    failed = [r["stage"] for r in records if r["status"] != "done"]
+    if failed or held_back:
+        print(f"❌ Pipeline run {run_id} incomplete ({', '.join(failed) or 'merge held back'})")
+        return False
+    print(f"✅ Pipeline run {run_id} finished in {run['duration_sec']}s")
+    return True
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="Fetch Retell calls and Shopify orders concurrently, then merge")
+    parser.add_argument("--full", action="store_true", help="full re-fetch and rebuild")
+    parser.add_argument("--partitions", type=int, default=None, help="passed to merge_new")
+    parser.add_argument("--workers", type=int, default=None, help="passed to merge_new")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = _parse_args(sys.argv[1:])
+    ok = run_pipeline(full=args.full, partitions=args.partitions, workers=args.workers)
+    sys.exit(0 if ok else 1)
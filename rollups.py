@@ -0,0 +1,63 @@
+import datetime
+
+# Per-day call totals. merge_new refreshes only the call dates a run touched;
+# the dashboard's call KPIs sum the daily rows instead of scanning calls.
+# Purchases, revenue and COGS per day and per product are out of scope: the
+# dashboard counts one purchase per customer, the earliest one in the selected
+# window, so which order is counted depends on where the window starts and
+# per-day rows can't be summed. Those figures come from attributed_purchases
+# through dashboard_queries.PURCHASES_CTE, a range scan on first_call_at.
+
+DAY_BATCH_SIZE = 200
+
+CALL_ROLLUP_INSERT = """
+    INSERT INTO daily_call_rollup (
+        call_date, total_calls, connected_calls, total_duration_sec, total_call_cost
+    )
+    SELECT
+        DATE(StartTimestamp),
+        COUNT(*),
+        COALESCE(SUM(TotalDurationSec > 1), 0),
+        COALESCE(SUM(TotalDurationSec), 0),
+        COALESCE(SUM(TotalCost), 0)
+    FROM calls
+    WHERE StartTimestamp IS NOT NULL {where}
+    GROUP BY DATE(StartTimestamp)
+"""
+
+
+def _day_filter(batch, column="StartTimestamp"):
+    # Range on the raw timestamp keeps the index usable; the IN list trims it
+    # down to exactly the touched days.
+    placeholders = ", ".join(["%s"] * len(batch))
+    where = f"AND {column} >= %s AND {column} < %s AND DATE({column}) IN ({placeholders})"
+    params = [batch[0], batch[-1] + datetime.timedelta(days=1)] + batch
+    return where, params
+
+
+def refresh_daily_rollups(conn, days=None):
+    # days=None rebuilds the rollup from scratch. Each batch is replaced in a
+    # single transaction so readers never see a half-refreshed day.
+    cursor = conn.cursor()
+    try:
+        if days is None:
+            cursor.execute("DELETE FROM daily_call_rollup")
+            cursor.execute(CALL_ROLLUP_INSERT.format(where=""))
+            conn.commit()
+            print("📊 Daily rollups rebuilt")
+            return
+
+        days = sorted({d for d in days if d is not None})
+        for start in range(0, len(days), DAY_BATCH_SIZE):
+            batch = days[start:start + DAY_BATCH_SIZE]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(f"DELETE FROM daily_call_rollup WHERE call_date IN ({placeholders})", batch)
+            where, params = _day_filter(batch)
+            cursor.execute(CALL_ROLLUP_INSERT.format(where=where), params)
+            conn.commit()
+        print(f"📊 Daily rollups refreshed for {len(days)} day(s)")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
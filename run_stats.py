@@ -0,0 +1,30 @@
+import threading
+
+# Counters a job collects while it runs (API calls, retries, rows, DB round
+# trips) and returns to its caller; pipeline.py records them per stage.
+# Thread-safe, since the Retell fetch updates them from several workers.
+
+UPSERT_KEYS = ("written", "failed", "round_trips")
+
+
+class RunStats:
+    def __init__(self, **initial):
+        self._lock = threading.Lock()
+        self._values = dict(initial)
+
+    def add(self, key, amount=1):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def add_upsert(self, upsert_stats):
+        # Folds in the stats dict returned by db_bulk.bulk_upsert()
+        for key in UPSERT_KEYS:
+            self.add(key, upsert_stats.get(key, 0))
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._values)
@@ -0,0 +1,190 @@
+import sys
+from db_connection import get_connection
+from line_items import migrate_line_items
+from phones import PHONE_KEY_SQL
+
+# Tables, columns and indexes added on top of the original calls / shopify_orders /
+# merged_data / product_cogs tables. Every statement is idempotent so the jobs can
+# call ensure_schema() at startup.
+TABLES = {
+    "sync_state": """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            sync_key VARCHAR(191) NOT NULL PRIMARY KEY,
+            sync_value VARCHAR(255),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """,
+    # Daily call totals maintained by merge_new (see rollups.py)
+    "daily_call_rollup": """
+        CREATE TABLE IF NOT EXISTS daily_call_rollup (
+            call_date DATE NOT NULL PRIMARY KEY,
+            total_calls INT NOT NULL DEFAULT 0,
+            connected_calls INT NOT NULL DEFAULT 0,
+            total_duration_sec DOUBLE NOT NULL DEFAULT 0,
+            total_call_cost DOUBLE NOT NULL DEFAULT 0,
+            refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """,
+    # Parsed shopify_orders.discount_codes, one row per order per code (see discount_codes.py)
+    "order_discount_codes": """
+        CREATE TABLE IF NOT EXISTS order_discount_codes (
+            order_number BIGINT NOT NULL,
+            code VARCHAR(191) NOT NULL,
+            amount DECIMAL(12, 2) NULL,
+            discount_type VARCHAR(32) NULL,
+            PRIMARY KEY (order_number, code),
+            INDEX idx_order_discount_codes_code (code, order_number)
+        )
+    """,
+    # One row per product per order, replacing shopify_orders.line_items (see line_items.py)
+    "shopify_order_line_items": """
+        CREATE TABLE IF NOT EXISTS shopify_order_line_items (
+            order_number BIGINT NOT NULL,
+            title VARCHAR(255) NOT NULL,
+            quantity INT NOT NULL DEFAULT 1,
+            price DECIMAL(12, 2) NULL,
+            PRIMARY KEY (order_number, title)
+        )
+    """,
+    # First qualifying call per customer order, maintained by merge_new (see attribution.py)
+    "attributed_purchases": """
+        CREATE TABLE IF NOT EXISTS attributed_purchases (
+            Email VARCHAR(255) NOT NULL,
+            order_number BIGINT NOT NULL,
+            first_call_at DATETIME NOT NULL,
+            created_at DATETIME NOT NULL,
+            title VARCHAR(255) NOT NULL,
+            customer_first_name VARCHAR(255) NULL,
+            total_price DOUBLE NULL,
+            COGS DOUBLE NULL,
+            PRIMARY KEY (Email, order_number),
+            INDEX idx_attributed_purchases_first_call (first_call_at),
+            INDEX idx_attributed_purchases_order (order_number)
+        )
+    """,
+    # Per-stage checkpoints and metrics written by pipeline.py
+    "pipeline_runs": """
+        CREATE TABLE IF NOT EXISTS pipeline_runs (
+            run_id VARCHAR(32) NOT NULL,
+            stage VARCHAR(32) NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            started_at DATETIME NULL,
+            finished_at DATETIME NULL,
+            duration_sec DOUBLE NULL,
+            metrics TEXT NULL,
+            error TEXT NULL,
+            PRIMARY KEY (run_id, stage),
+            INDEX idx_pipeline_runs_started_at (started_at)
+        )
+    """,
+}
+
+COLUMNS = [
+    ("shopify_orders", "updated_at", "DATETIME NULL"),
+    ("calls", "phone_key", "CHAR(10) NULL"),
+    ("shopify_orders", "phone_key", "CHAR(10) NULL"),
+    # When MySQL last wrote the row; merge_new's watermarks are on this, not on
+    # call / order time, so late-arriving rows are still picked up
+    ("calls", "ingested_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+    ("shopify_orders", "ingested_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+]
+
+INDEXES = [
+    ("shopify_orders", "idx_shopify_orders_updated_at", "(updated_at)"),
+    ("calls", "idx_calls_phone_key", "(phone_key)"),
+    ("shopify_orders", "idx_shopify_orders_phone_key", "(phone_key)"),
+    ("calls", "idx_calls_ingested_at", "(ingested_at)"),
+    ("shopify_orders", "idx_shopify_orders_ingested_at", "(ingested_at)"),
+    # Dashboard date windows and its data-version probe
+    ("calls", "idx_calls_start", "(StartTimestamp)"),
+    ("merged_data", "idx_merged_data_start", "(StartTimestamp)"),
+]
+
+# Source column of each table's phone_key (see phones.py)
+PHONE_KEY_SOURCES = {"calls": "to_number", "shopify_orders": "phone"}
+BACKFILL_BATCH_SIZE = 10000
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (table, column))
+    return cursor.fetchone() is not None
+
+
+def _index_exists(cursor, table, index):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+    """, (table, index))
+    return cursor.fetchone() is not None
+
+
+def _needs_phone_key_backfill(cursor):
+    # Any row with digits in its source column but no phone_key, e.g. rows
+    # written by an older job after the column was added. Each probe stops at
+    # the first match.
+    for table, source in PHONE_KEY_SOURCES.items():
+        cursor.execute(f"SELECT 1 FROM {table} WHERE phone_key IS NULL AND {source} REGEXP '[0-9]' LIMIT 1")
+        if cursor.fetchone() is not None:
+            return True
+    return False
+
+
+def backfill_phone_keys(conn):
+    # Fills phone_key for rows ingested without one. Batched so it never holds
+    # long locks on the live tables.
+    cursor = conn.cursor()
+    try:
+        for table, source in PHONE_KEY_SOURCES.items():
+            total = 0
+            while True:
+                cursor.execute(f"""
+                    UPDATE {table} SET phone_key = {PHONE_KEY_SQL.format(column=source)}
+                    WHERE phone_key IS NULL AND {source} REGEXP '[0-9]'
+                    LIMIT %s
+                """, (BACKFILL_BATCH_SIZE,))
+                conn.commit()
+                total += cursor.rowcount
+                if cursor.rowcount < BACKFILL_BATCH_SIZE:
+                    break
+            print(f"🛠️ Backfilled phone_key for {total} {table} rows")
+    finally:
+        cursor.close()
+
+
+def ensure_schema(conn):
+    cursor = conn.cursor()
+    try:
+        for ddl in TABLES.values():
+            cursor.execute(ddl)
+        for table, column, definition in COLUMNS:
+            if not _column_exists(cursor, table, column):
+                print(f"🛠️ Adding column {table}.{column}")
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        for table, index, columns in INDEXES:
+            if not _index_exists(cursor, table, index):
+                print(f"🛠️ Adding index {index} on {table}")
+                cursor.execute(f"CREATE INDEX {index} ON {table} {columns}")
+        conn.commit()
+        backfill = _needs_phone_key_backfill(cursor)
+    finally:
+        cursor.close()
+    if backfill:
+        backfill_phone_keys(conn)
+
+
+if __name__ == "__main__":
+    conn = get_connection()
+    ensure_schema(conn)
+    if "--backfill-phone-keys" in sys.argv[1:]:
+        backfill_phone_keys(conn)
+    if "--migrate-line-items" in sys.argv[1:]:
+        cursor = conn.cursor()
+        has_json = _column_exists(cursor, "shopify_orders", "line_items")
+        cursor.close()
+        if has_json:
+            migrate_line_items(conn, drop_json="--drop-line-items-json" in sys.argv[1:])
+    conn.close()
+    print("✅ Schema is up to date")
@@ -0,0 +1,255 @@
+import argparse
+import base64
+import glob
+import hashlib
+import hmac
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from dotenv import load_dotenv
+from db_connection import get_connection
+from fetch_shopify import ORDER_COLUMNS, order_to_row, store_orders
+from merge_new import merge_data
+from schema import ensure_schema
+
+load_dotenv()
+
+# Receiver for Shopify's orders/create and orders/updated webhooks, so new
+# orders reach MySQL within seconds instead of waiting for the 2-hourly poll.
+# Requests are HMAC-checked and queued; a background writer stores them in
+# micro-batches through fetch_shopify.store_orders and, at most every
+# WEBHOOK_MERGE_SECONDS, runs an incremental merge so the dashboard sees them.
+# The polling sync stays as the reconciliation pass for anything missed.
+#
+# Local testing without a store:
+#   python shopify_webhook.py --dry-run
+#   python shopify_webhook.py --replay samples/*.json
+# --dry-run maps and logs the rows instead of writing them; --replay signs
+# saved payloads with SHOPIFY_WEBHOOK_SECRET and POSTs them to the receiver.
+
+WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhooks/shopify/orders")
+BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))
+FLUSH_SECONDS = float(os.getenv("WEBHOOK_FLUSH_SECONDS", "2"))
+QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+MERGE_SECONDS = float(os.getenv("WEBHOOK_MERGE_SECONDS", "300"))  # 0 disables the merge
+
+ORDER_TOPICS = {"orders/create", "orders/updated"}
+
+
+def sign(body, secret):
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def verify_hmac(body, header, secret):
+    if not secret or not header:
+        return False
+    return hmac.compare_digest(sign(body, secret), header.strip())
+
+
+class WebhookWriter(threading.Thread):
+    # Drains the queue into MySQL: a batch is flushed once it holds
+    # BATCH_SIZE orders or FLUSH_SECONDS after its first one arrived. Orders
+    # repeated within a batch keep only their latest payload.
+    def __init__(self, orders, dry_run=False):
+        super().__init__(name="webhook-writer", daemon=True)
+        self.orders = orders
+        self.dry_run = dry_run
+        self.stopping = threading.Event()
+        self.stats = {"received": 0, "written": 0, "failed": 0, "batches": 0, "merges": 0}
+        self.last_merge = time.monotonic()
+        self.unmerged = 0
+
+    def run(self):
+        while not (self.stopping.is_set() and self.orders.empty()):
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+            self._maybe_merge()
+
+    def _collect(self):
+        batch = {}
+        deadline = None
+        while len(batch) < BATCH_SIZE:
+            timeout = 0.5 if deadline is None else deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                order = self.orders.get(timeout=timeout)
+            except queue.Empty:
+                if deadline is None:
+                    return batch  # idle; let run() check for shutdown
+                continue
+            self.stats["received"] += 1
+            if deadline is None:
+                deadline = time.monotonic() + FLUSH_SECONDS
+            key = order.get("order_number") or order.get("id")
+            previous = batch.get(key)
+            if previous is None or (order.get("updated_at") or "") >= (previous.get("updated_at") or ""):
+                batch[key] = order
+        return batch
+
+    def _flush(self, batch):
+        orders = list(batch.values())
+        self.stats["batches"] += 1
+        if self.dry_run:
+            rows = [dict(zip(ORDER_COLUMNS, order_to_row(order))) for order in orders]
+            for row in rows:
+                print(f"🧪 Dry run: order {row['order_number']} ({row['email']}, {row['title']}, phone_key {row['phone_key']})")
+            self.stats["written"] += len(rows)
+            return
+        try:
+            conn = get_connection()
+            try:
+                written = store_orders(conn, orders)["written"]
+            finally:
+                conn.close()
+        except Exception as e:
+            # The next reconciliation poll picks these orders up again
+            self.stats["failed"] += len(orders)
+            print(f"❌ Webhook batch of {len(orders)} orders not stored: {e}")
+            return
+        self.stats["written"] += written
+        self.unmerged += written
+        print(f"📥 Webhook batch: {written}/{len(orders)} orders stored")
+
+    def _maybe_merge(self):
+        if self.dry_run or not MERGE_SECONDS or not self.unmerged:
+            return
+        if time.monotonic() - self.last_merge < MERGE_SECONDS and not self.stopping.is_set():
+            return
+        try:
+            merge_data()
+            self.stats["merges"] += 1
+            self.unmerged = 0
+        except Exception as e:
+            print(f"❌ Webhook merge failed, retrying next interval: {e}")
+        self.last_merge = time.monotonic()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server_version = "TrimfinityWebhook/1.0"
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/healthz":
+            return self._reply(404, {"error": "not found"})
+        writer = self.server.writer
+        self._reply(200, {"queued": writer.orders.qsize(), **writer.stats})
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            return self._reply(404, {"error": "not found"})
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not verify_hmac(body, self.headers.get("X-Shopify-Hmac-Sha256"), WEBHOOK_SECRET):
+            return self._reply(401, {"error": "invalid hmac"})
+        topic = self.headers.get("X-Shopify-Topic", "")
+        if topic not in ORDER_TOPICS:
+            return self._reply(200, {"ignored": topic})
+        try:
+            order = json.loads(body)
+        except ValueError:
+            return self._reply(400, {"error": "invalid json"})
+        if not isinstance(order, dict):
+            return self._reply(400, {"error": "expected an order object"})
+        try:
+            # Shopify expects a reply within seconds, so only enqueue here
+            self.server.writer.orders.put_nowait(order)
+        except queue.Full:
+            # Non-2xx makes Shopify retry the delivery later
+            return self._reply(503, {"error": "queue full"})
+        self._reply(200, {"queued": True})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(dry_run=False):
+    if not WEBHOOK_SECRET:
+        print("❌ Missing SHOPIFY_WEBHOOK_SECRET in .env")
+        return
+    if not dry_run:
+        conn = get_connection()
+        ensure_schema(conn)
+        conn.close()
+
+    writer = WebhookWriter(queue.Queue(maxsize=QUEUE_SIZE), dry_run=dry_run)
+    writer.start()
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    server.writer = writer
+    mode = " (dry run, nothing is written)" if dry_run else ""
+    print(f"🛰️ Listening for Shopify order webhooks on http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}{mode}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        writer.stopping.set()
+        writer.join()
+        print(f"✅ Webhook receiver stopped: {writer.stats}")
+
+
+def _replay_payloads(paths):
+    # Each file holds one order, a list of orders, or {"orders": [...]} as
+    # saved from orders.json
+    for path in paths:
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict) and "orders" in data:
+            data = data["orders"]
+        for order in data if isinstance(data, list) else [data]:
+            yield path, order
+
+
+def replay(patterns, url, topic="orders/updated"):
+    if not WEBHOOK_SECRET:
+        print("❌ Missing SHOPIFY_WEBHOOK_SECRET in .env")
+        return False
+    paths = sorted({p for pattern in patterns for p in glob.glob(pattern)})
+    sent = failed = 0
+    for path, order in _replay_payloads(paths):
+        body = json.dumps(order).encode("utf-8")
+        response = requests.post(url, data=body, headers={
+            "Content-Type": "application/json",
+            "X-Shopify-Topic": topic,
+            "X-Shopify-Hmac-Sha256": sign(body, WEBHOOK_SECRET),
+        })
+        if response.status_code == 200:
+            sent += 1
+        else:
+            failed += 1
+            print(f"❌ {path}: order {order.get('order_number')} -> {response.status_code} {response.text}")
+    print(f"✅ Replayed {sent} order(s) from {len(paths)} file(s), {failed} rejected")
+    return failed == 0
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="Receive Shopify order webhooks and store them in MySQL")
+    parser.add_argument("--dry-run", action="store_true", help="log mapped rows instead of writing to MySQL")
+    parser.add_argument("--replay", nargs="+", metavar="FILE", help="sign and POST saved order payloads to a running receiver")
+    parser.add_argument("--url", default=f"http://localhost:{WEBHOOK_PORT}{WEBHOOK_PATH}", help="receiver URL for --replay")
+    parser.add_argument("--topic", default="orders/updated", choices=sorted(ORDER_TOPICS), help="topic header for --replay")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = _parse_args(sys.argv[1:])
+    if args.replay:
+        sys.exit(0 if replay(args.replay, args.url, args.topic) else 1)
+    serve(dry_run=args.dry_run)
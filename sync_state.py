@@ -0,0 +1,44 @@
+import time
+
+# Watermarks / cursors shared by the sync jobs, stored in the sync_state table
+# (see schema.py) so every cron run picks up where the previous one stopped.
+
+def get_watermark(conn, key):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT sync_value FROM sync_state WHERE sync_key = %s", (key,))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    return row[0] if row else None
+
+
+def set_watermark(conn, key, value):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO sync_state (sync_key, sync_value)
+            VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE sync_value = VALUES(sync_value)
+        """, (key, None if value is None else str(value)))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def clear_watermark(conn, key):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM sync_state WHERE sync_key = %s", (key,))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+# Bumped by the merge job after every successful run; the dashboard keys its
+# cache on it so a new sync invalidates cached frames right away.
+DATA_VERSION_KEY = "dashboard.data_version"
+
+
+def bump_data_version(conn):
+    set_watermark(conn, DATA_VERSION_KEY, time.time())
@@ -0,0 +1,208 @@
+import json
+import threading
+import time
+import pandas as pd
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import fetch_retell
+from fetch_retell import SharedBackoff, fetch_calls_for_number, parse_calls, parse_calls_frame
+from phones import normalize_phone
+from run_stats import RunStats
+
+NUMBER = "+15109411358"
+
+
+def make_call(i, start_ms, **overrides):
+    call = {
+        "call_id": f"call-{i}",
+        "from_number": NUMBER,
+        "to_number": f"+9198765{i:05d}",
+        "start_timestamp": start_ms,
+        "end_timestamp": start_ms + 90_000,
+        "retell_llm_dynamic_variables": {"email": f"c{i}@example.com", "title": "Trimfinity 7000"},
+    }
+    call.update(overrides)
+    return call
+
+
+class MockRetell(BaseHTTPRequestHandler):
+    # Serves /v2/list-calls from server.calls (newest first), honouring limit,
+    # pagination_key and a scripted list of (status, headers) failures.
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((time.monotonic(), payload))
+        if self.server.failures:
+            status, headers = self.server.failures.pop(0)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        numbers = payload["filter_criteria"]["from_number"]
+        calls = [c for c in self.server.calls if c["from_number"] in numbers]
+        if "pagination_key" in payload:
+            ids = [c["call_id"] for c in calls]
+            calls = calls[ids.index(payload["pagination_key"]) + 1:]
+        body = json.dumps(calls[:payload["limit"]]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def retell(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockRetell)
+    server.calls = []
+    server.failures = []
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(fetch_retell, "RETELL_API_BASE", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(fetch_retell, "PAGE_LIMIT", 3)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_pages_with_pagination_key(retell):
+    base = 1_700_000_000_000
+    retell.calls = [make_call(i, base - i * 60_000) for i in range(7)]
+
+    df, latest_ms = fetch_calls_for_number(NUMBER, "key")
+
+    assert len(df) == 7
+    assert latest_ms == base
+    keys = [payload.get("pagination_key") for _, payload in retell.requests]
+    assert keys == [None, "call-2", "call-5"]
+    assert all(payload["filter_criteria"] == {"from_number": [NUMBER]} for _, payload in retell.requests)
+
+
+def test_stops_at_watermark(retell):
+    base = 1_700_000_000_000
+    retell.calls = [make_call(i, base - i * 60_000) for i in range(7)]
+    since_ms = base - 90_000  # falls inside the first page
+
+    df, _ = fetch_calls_for_number(NUMBER, "key", since_ms=since_ms)
+
+    assert len(retell.requests) == 1
+    assert retell.requests[0][1]["filter_criteria"]["start_timestamp"] == {"lower_threshold": since_ms}
+    assert len(df) == 3
+
+
+def test_429_retry_after_goes_through_shared_backoff(retell):
+    retell.calls = [make_call(0, 1_700_000_000_000)]
+    retell.failures = [(429, {"Retry-After": "0.3"})]
+    backoff = SharedBackoff()
+    stats = RunStats()
+
+    df, _ = fetch_calls_for_number(NUMBER, "key", backoff=backoff, stats=stats)
+
+    assert len(df) == 1
+    assert stats.as_dict() == {"api_calls": 2, "retries": 1}
+    (first_at, _), (second_at, _) = retell.requests
+    assert second_at - first_at >= 0.3
+    # Another worker sharing the backoff is held back by the same window
+    backoff.penalize(0.2)
+    started = time.monotonic()
+    backoff.wait()
+    assert time.monotonic() - started >= 0.15
+
+
+class FakeConnection:
+    def close(self):
+        pass
+
+
+def test_watermark_held_for_number_with_failed_rows(retell, monkeypatch):
+    other = "+12283350337"
+    base = 1_700_000_000_000
+    retell.calls = [make_call(0, base), make_call(1, base - 60_000, from_number=other)]
+    saved = {}
+
+    def fake_upsert(conn, table, columns, rows, update_columns=None, label=None):
+        failed = len(rows) if other in label else 0
+        return {"rows": len(rows), "written": len(rows) - failed, "failed": failed, "chunks": 1, "round_trips": 1}
+
+    monkeypatch.setenv("RETELL_API_KEY", "key")
+    monkeypatch.setattr(fetch_retell, "allowed_numbers", [NUMBER, other])
+    monkeypatch.setattr(fetch_retell, "get_connection", FakeConnection)
+    monkeypatch.setattr(fetch_retell, "ensure_schema", lambda conn: None)
+    monkeypatch.setattr(fetch_retell, "get_watermark", lambda conn, key: None)
+    monkeypatch.setattr(fetch_retell, "set_watermark", lambda conn, key, value: saved.__setitem__(key, value))
+    monkeypatch.setattr(fetch_retell, "bulk_upsert", fake_upsert)
+
+    stats = fetch_retell.fetch_and_store_call_data()
+
+    assert saved == {f"retell_calls.{NUMBER}": base}
+    assert (stats["written"], stats["failed"], stats["errors"]) == (1, 1, 0)
+
+
+def baseline_parse_calls(call_list, number):
+    # The per-call loop parse_calls_frame replaced
+    parsed_data = []
+    for call in call_list:
+        try:
+            from_number = call.get("from_number", "")
+            if from_number != number:
+                continue
+            email = call.get("retell_llm_dynamic_variables", {}).get("email")
+            product_title = call.get("retell_llm_dynamic_variables", {}).get("title")
+            start_ms = call.get("start_timestamp")
+            end_ms = call.get("end_timestamp")
+            if not start_ms or not end_ms:
+                continue
+            start_dt = pd.to_datetime(start_ms, unit='ms')
+            end_dt = pd.to_datetime(end_ms, unit='ms')
+            duration_sec = (end_dt - start_dt).total_seconds()
+            total_cost = round(duration_sec * 0.00234 * 85, 4)
+
+            raw_to_number = call.get("to_number", "")
+            if raw_to_number.startswith("+91") and len(raw_to_number) > 3:
+                to_number = raw_to_number[-10:]
+            else:
+                to_number = raw_to_number
+
+            parsed_data.append({
+                "email": email,
+                "StartTimestamp": start_dt,
+                "EndTimestamp": end_dt,
+                "TotalDurationSec": duration_sec,
+                "TotalCost": total_cost,
+                "title": product_title,
+                "to_number": to_number
+            })
+        except Exception:
+            continue
+    return parsed_data
+
+
+def test_parse_calls_frame_matches_baseline_loop():
+    base = 1_700_000_000_000
+    calls = [
+        make_call(0, base),
+        make_call(1, base + 1, end_timestamp=base + 123_457),
+        make_call(2, base, from_number="+12283350337"),
+        make_call(3, base, start_timestamp=None),
+        make_call(4, base, end_timestamp=0),
+        make_call(5, base, retell_llm_dynamic_variables=None),
+        make_call(6, base, retell_llm_dynamic_variables={}),
+        make_call(7, base, to_number=None),
+        make_call(8, base, to_number="+14155550123"),
+        make_call(9, base, to_number="+91"),
+        make_call(10, base, to_number=""),
+        {"call_id": "call-11", "from_number": NUMBER},
+    ]
+
+    expected = baseline_parse_calls(calls, NUMBER)
+    records = parse_calls(calls, NUMBER)
+
+    assert [{k: v for k, v in r.items() if k != "phone_key"} for r in records] == expected
+    kept = {"call-0", "call-1", "call-6", "call-8", "call-9", "call-10"}
+    assert [r["phone_key"] for r in records] == [normalize_phone(c["to_number"]) for c in calls if c["call_id"] in kept]
+    assert list(parse_calls_frame([], NUMBER).columns) == fetch_retell.CALL_COLUMNS
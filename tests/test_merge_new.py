@@ -0,0 +1,74 @@
+import zlib
+import numpy as np
+import pandas as pd
+from merge_new import WRITE_INPUT_COLUMNS, build_merged
+from phones import normalize_phone
+
+PARTITIONS = 4
+
+
+def make_frames(seed=7):
+    # Few distinct timestamps, durations and emails, and several spellings of
+    # each phone, so many calls tie on (phone, StartTimestamp)
+    rng = np.random.default_rng(seed)
+    phones = [f"98{n:08d}" for n in rng.integers(0, 10 ** 8, 30)]
+    formats = ["+91{}", "0{}", "{}", "+91 {}"]
+    moments = pd.date_range("2024-01-01", periods=12, freq="h")
+    calls = pd.DataFrame({
+        "email": rng.choice(["a@x.com", "b@x.com", None], 400),
+        "StartTimestamp": rng.choice(moments, 400),
+        "TotalDurationSec": rng.choice([0.0, 5.0, 30.0], 400),
+        "TotalCost": rng.choice([0.1, 0.2], 400),
+        "title": rng.choice(["Trimfinity Edge Shave", None], 400),
+        "to_number": [rng.choice(formats).format(rng.choice(phones)) for _ in range(400)],
+    })
+    orders = pd.DataFrame({
+        "email": rng.choice(["a@x.com", "", None], 120),
+        "order_number": np.repeat(np.arange(1001, 1061), 2),
+        "created_at": np.repeat(rng.choice(moments, 60), 2),
+        "total_price": "999.00",
+        "discount_codes": None,
+        "customer_first_name": "Asha",
+        "title": ["Trimfinity Smart Blade", "Trimfinity Edge Shave"] * 60,
+        "quantity": 1,
+        "phone": np.repeat([rng.choice(formats).format(rng.choice(phones)) for _ in range(60)], 2),
+    })
+    calls["phone_key"] = calls["to_number"].map(normalize_phone)
+    orders["phone_key"] = orders["phone"].map(normalize_phone)
+    return calls, orders
+
+
+def partition_of(keys):
+    # MOD(CRC32(phone_key), PARTITIONS), as merge_new._read_partition asks MySQL
+    return keys.map(lambda key: zlib.crc32(key.encode()) % PARTITIONS)
+
+
+def canonical(df_merged):
+    out = df_merged[WRITE_INPUT_COLUMNS].astype(object)
+    out = out.where(out.notna(), None)
+    return out.sort_values(["order_number", "title"]).reset_index(drop=True)
+
+
+def test_partitioned_merge_matches_single_pass():
+    calls, orders = make_frames()
+    expected = canonical(build_merged(calls.copy(), orders.copy(), None))
+    assert len(expected) > 0
+
+    call_parts, order_parts = partition_of(calls["phone_key"]), partition_of(orders["phone_key"])
+    partitioned = pd.concat([
+        build_merged(calls[call_parts == p].copy(), orders[order_parts == p].copy(), None)
+        for p in range(PARTITIONS)
+    ], ignore_index=True)
+    pd.testing.assert_frame_equal(canonical(partitioned), expected)
+
+
+def test_merge_ignores_input_order():
+    calls, orders = make_frames()
+    expected = canonical(build_merged(calls.copy(), orders.copy(), None))
+    for seed in range(3):
+        shuffled = build_merged(
+            calls.sample(frac=1, random_state=seed).reset_index(drop=True),
+            orders.sample(frac=1, random_state=seed).reset_index(drop=True),
+            None
+        )
+        pd.testing.assert_frame_equal(canonical(shuffled), expected)
@@ -0,0 +1,94 @@
+import glob
+import json
+import os
+import queue
+import threading
+import pytest
+import requests
+from http.server import ThreadingHTTPServer
+import shopify_webhook
+from fetch_shopify import ORDER_COLUMNS, order_to_row
+from shopify_webhook import WebhookHandler, WebhookWriter, replay, sign
+
+SECRET = "test-secret"
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "samples")
+
+
+def load_sample(name):
+    with open(os.path.join(SAMPLES, name)) as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def receiver(monkeypatch):
+    # The writer thread isn't started, so accepted orders stay in its queue
+    monkeypatch.setattr(shopify_webhook, "WEBHOOK_SECRET", SECRET)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WebhookHandler)
+    server.writer = WebhookWriter(queue.Queue(), dry_run=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_address[1]}{shopify_webhook.WEBHOOK_PATH}"
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body, topic="orders/create", hmac_header=None):
+    return requests.post(url, data=body, headers={
+        "Content-Type": "application/json",
+        "X-Shopify-Topic": topic,
+        "X-Shopify-Hmac-Sha256": hmac_header if hmac_header is not None else sign(body, SECRET),
+    })
+
+
+def test_valid_hmac_is_queued(receiver):
+    server, url = receiver
+    order = load_sample("orders_create.json")
+    body = json.dumps(order).encode("utf-8")
+
+    response = post(url, body)
+
+    assert response.status_code == 200
+    assert response.json() == {"queued": True}
+    assert server.writer.orders.get_nowait() == order
+
+
+def test_bad_hmac_is_rejected(receiver):
+    server, url = receiver
+    body = json.dumps(load_sample("orders_create.json")).encode("utf-8")
+
+    response = post(url, body, hmac_header=sign(body, "wrong-secret"))
+
+    assert response.status_code == 401
+    assert server.writer.orders.empty()
+
+
+def test_other_topics_are_ignored(receiver):
+    server, url = receiver
+    body = json.dumps({"id": 1, "title": "Trimfinity 7000"}).encode("utf-8")
+
+    response = post(url, body, topic="products/update")
+
+    assert response.status_code == 200
+    assert response.json() == {"ignored": "products/update"}
+    assert server.writer.orders.empty()
+
+
+def test_replay_posts_every_sample(receiver):
+    server, url = receiver
+
+    assert replay([os.path.join(SAMPLES, "*.json")], url)
+
+    orders = []
+    while not server.writer.orders.empty():
+        orders.append(server.writer.orders.get_nowait())
+    assert sorted(o["order_number"] for o in orders) == [10421, 10421, 10422]
+    rows = [dict(zip(ORDER_COLUMNS, order_to_row(o))) for o in orders]
+    assert {row["order_number"]: row["phone_key"] for row in rows} == {10421: "9876543210", 10422: "9812345678"}
+
+
+def test_samples_are_valid_order_payloads():
+    paths = glob.glob(os.path.join(SAMPLES, "*.json"))
+    assert paths
+    for path, order in shopify_webhook._replay_payloads(sorted(paths)):
+        assert isinstance(order, dict), path
+        assert order.get("order_number") and order.get("line_items"), path